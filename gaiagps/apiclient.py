@@ -1,15 +1,27 @@
+import hashlib
 import itertools
+import json
 import logging
 import os
 import re
 import requests
 import sys
 import pprint
+import time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 logging.getLogger('requests').setLevel(logging.ERROR)
 
 BASE = 'https://www.gaiagps.com'
+CACHE_DIR = os.path.expanduser(os.path.join('~', '.cache', 'gaiagpsclient'))
+# Cached lists untouched for this long (seconds) are deleted, since
+# every cookie session gets its own files
+CACHE_EXPIRE = 7 * 24 * 3600
 LOG = logging.getLogger(__name__)
 
 
@@ -42,8 +54,9 @@ def match(iterable, key, pattern):
     :param pattern: A regular expression to use for matching
     :returns: A list of objects that match
     """
+    regex = re.compile(pattern)
     return [i for i in iterable
-            if re.search(pattern, i[key])]
+            if regex.search(i[key])]
 
 
 def find(iterable, key, value):
@@ -64,9 +77,57 @@ def find(iterable, key, value):
     return matches[0]
 
 
+def index_by(iterable, key):
+    """Index iterable by ``key`` for repeated lookups.
+
+    Use this instead of calling :func:`find` several times on the same
+    list. The key should be unique, like ``id``; for duplicates, the
+    last item wins.
+
+    :param iterable: Items to index
+    :param key: The key to index by
+    :returns: A ``dict`` of items by their ``key``
+    :rtype: `dict`
+    """
+    return {i[key]: i for i in iterable}
+
+
 def _logresp(r):
-    LOG.debug('Response: %s %s: %r' % (r.status_code, r.reason,
-                                       r.content))
+    # Let logging format this only if it is going to be emitted, since
+    # the response content can be large
+    LOG.debug('Response: %s %s: %r', r.status_code, r.reason, r.content)
+
+
+def _load_json(path):
+    # The cached lists can be large, so use orjson for them if we can
+    if orjson is not None:
+        with open(path, 'rb') as f:
+            return orjson.loads(f.read())
+    with open(path) as f:
+        return json.load(f)
+
+
+def _dump_json(obj, path):
+    # Only the owner may read the cached lists
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    if orjson is not None:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(orjson.dumps(obj))
+    else:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(obj, f)
+
+
+def _prune_cache():
+    cutoff = time.time() - CACHE_EXPIRE
+    for entry in os.scandir(CACHE_DIR):
+        if not entry.name.endswith('.json'):
+            continue
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.unlink(entry.path)
+        except OSError:
+            pass
 
 
 USER_AGENT_ELEMENTS = [
@@ -152,21 +213,73 @@ class GaiaClient(object):
 
         LOG.info('Login successful')
 
-    def list_objects(self, objtype, archived=True):
+    def _account_key(self):
+        if self.username:
+            return 'user:%s' % self.username
+        # Logged in from saved cookies, so the session is all that
+        # tells one account from another
+        session = sorted('%s=%s' % (c.name, c.value) for c in self.s.cookies)
+        if session:
+            return 'session:%s' % ';'.join(session)
+
+    def _cache_file(self, objtype, archived):
+        key = self._account_key()
+        if key is None:
+            return None
+        user = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(CACHE_DIR, '%s-%s%s.json' % (
+            objtype, user[:12], '' if archived else '-unarchived'))
+
+    def _drop_cache(self):
+        # Any change may show up in any of the lists (like a folder's
+        # contents), so forget all of them
+        for objtype in ('folder', 'track', 'waypoint', 'photo'):
+            for archived in (True, False):
+                cache_file = self._cache_file(objtype, archived)
+                if cache_file is None:
+                    return
+                try:
+                    os.unlink(cache_file)
+                except OSError:
+                    pass
+
+    def list_objects(self, objtype, archived=True, max_age=None):
         """Returns a list of object descriptions.
 
         This is similar to the result of :func:`~get_object()`, but with object
         references instead of full objects.
 
+        If ``max_age`` is provided, the result is also cached on disk
+        (in :data:`CACHE_DIR`), and a cached result no older than that is
+        returned instead of asking the server. Only use this where slightly
+        stale data is acceptable. The cache is per account (by username,
+        or by session cookies if we have no username), and is not used
+        if we have neither. Changes made through this client discard
+        the account's cached lists, and lists unused for
+        :data:`CACHE_EXPIRE` seconds are deleted.
+
         :param objtype: The type of object to be listed
         :type objtype: str
         :param archived: If ``True``, archived objects will be included
         :type archived: bool
+        :param max_age: Maximum age (in seconds) of a cached result to use
+        :type max_age: int
         :returns: A list of objects
         :rtype: `list`
         """
         assert objtype in ('folder', 'track', 'waypoint', 'photo')
 
+        # We cannot cache for an account we cannot identify
+        cache_file = (self._cache_file(objtype, archived)
+                      if max_age is not None else None)
+        if cache_file is not None:
+            try:
+                if time.time() - os.path.getmtime(cache_file) < max_age:
+                    LOG.debug('Using cached %s list' % objtype)
+                    return _load_json(cache_file)
+            except (OSError, ValueError):
+                pass
+
         r = self.s.get(gurl('api', 'objects', objtype),
                        params={
                            'count': '5000', 'page': '1',
@@ -176,7 +289,19 @@ class GaiaClient(object):
                            'sort_direction': 'desc',
                            'sort_field': 'create_date',
                        })
-        return r.json()
+        objs = r.json()
+
+        if cache_file is not None:
+            try:
+                os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+                _prune_cache()
+                # Write and rename so a reader never sees a partial file
+                _dump_json(objs, cache_file + '.tmp')
+                os.replace(cache_file + '.tmp', cache_file)
+            except OSError as e:
+                LOG.warning('Unable to cache %s list: %s' % (objtype, e))
+
+        return objs
 
     def lookup_object(self, objtype, name):
         """Lookup a single object by name.
@@ -232,8 +357,8 @@ class GaiaClient(object):
         result = self.s.get(gurl('api', 'objects', objtype, resource))
         if fmt is None:
             objdata = result.json()
-            LOG.debug('Retrieved object %s/%s: %s' % (
-                objtype, resource, objdata))
+            LOG.debug('Retrieved object %s/%s: %s',
+                      objtype, resource, objdata)
             return objdata
         else:
             return result.content
@@ -248,9 +373,11 @@ class GaiaClient(object):
         :returns: The resulting object, if successful, else ``None``
         :rtype: `dict`
         """
-        LOG.debug('Creating %s: %s' % (objtype, pprint.pformat(objdata)))
+        if LOG.isEnabledFor(logging.DEBUG):
+            LOG.debug('Creating %s: %s' % (objtype, pprint.pformat(objdata)))
         r = self.s.post(gurl('api', 'objects', objtype), json=objdata)
         _logresp(r)
+        self._drop_cache()
         if r:
             obj = r.json()
             if 'id' not in obj and 'id' in obj.get('properties', {}):
@@ -268,11 +395,13 @@ class GaiaClient(object):
         :returns: The resulting object, if successful, else ``None``
         :rtype: `dict`
         """
-        LOG.debug('Putting %s/%s: %s' % (objtype, objdata['id'],
-                                         pprint.pformat(objdata)))
+        if LOG.isEnabledFor(logging.DEBUG):
+            LOG.debug('Putting %s/%s: %s' % (objtype, objdata['id'],
+                                             pprint.pformat(objdata)))
         r = self.s.put(gurl('api', 'objects', objtype, objdata['id']),
                        json=objdata)
         _logresp(r)
+        self._drop_cache()
         if r.status_code <= 201:
             return r.json()
         elif r.status_code < 299:
@@ -288,6 +417,7 @@ class GaiaClient(object):
         """
         r = self.s.delete(gurl('api', 'objects', objtype, id_))
         _logresp(r)
+        self._drop_cache()
 
     def add_object_to_folder(self, folderid, objtype, objid):
         """Adds an object to a folder.
@@ -301,6 +431,23 @@ class GaiaClient(object):
         :returns: The updated folder description
         :rtype: `dict`
         """
+        return self.add_objects_to_folder(folderid, objtype, [objid])
+
+    def add_objects_to_folder(self, folderid, objtype, objids):
+        """Adds multiple objects of the same type to a folder.
+
+        This updates the folder with a single request, regardless of
+        the number of objects being added.
+
+        :param folderid: The id if the folder in question
+        :type folderid: str
+        :param objtype: The type of the objects to add
+        :type objtype: str
+        :param objids: The ids of the objects to add
+        :type objids: list
+        :returns: The updated folder description
+        :rtype: `dict`
+        """
 
         assert objtype in ('waypoint', 'track', 'folder', 'photo')
 
@@ -312,11 +459,13 @@ class GaiaClient(object):
             folder_list_key = 'children'
         else:
             folder_list_key = '%ss' % objtype
-        assert objid not in folder[folder_list_key]
-        folder[folder_list_key].append(objid)
+        for objid in objids:
+            assert objid not in folder[folder_list_key]
+        folder[folder_list_key].extend(objids)
 
-        LOG.debug('Updating folder %s: %s' % (folderid,
-                                              pprint.pformat(folder)))
+        if LOG.isEnabledFor(logging.DEBUG):
+            LOG.debug('Updating folder %s: %s' % (folderid,
+                                                  pprint.pformat(folder)))
 
         return self.put_object('folder', folder)
 
@@ -332,6 +481,23 @@ class GaiaClient(object):
         :returns: The updated folder description
         :rtype: `dict`
         """
+        return self.remove_objects_from_folder(folderid, objtype, [objid])
+
+    def remove_objects_from_folder(self, folderid, objtype, objids):
+        """Removes multiple objects of the same type from a folder.
+
+        This updates the folder with a single request, regardless of
+        the number of objects being removed.
+
+        :param folderid: The id of the folder in question
+        :type folderid: str
+        :param objtype: The type of the objects to remove
+        :type objtype: str
+        :param objids: The ids of the objects to remove
+        :type objids: list
+        :returns: The updated folder description
+        :rtype: `dict`
+        """
 
         assert objtype in ('waypoint', 'track', 'folder', 'photo')
 
@@ -342,31 +508,74 @@ class GaiaClient(object):
             folder_list_key = 'children'
         else:
             folder_list_key = '%ss' % objtype
-        assert objid in folder[folder_list_key]
-        folder[folder_list_key].remove(objid)
+        for objid in objids:
+            assert objid in folder[folder_list_key]
+            folder[folder_list_key].remove(objid)
 
-        LOG.debug('Updating folder %s: %s' % (folderid,
-                                              pprint.pformat(folder)))
+        if LOG.isEnabledFor(logging.DEBUG):
+            LOG.debug('Updating folder %s: %s' % (folderid,
+                                                  pprint.pformat(folder)))
 
         return self.put_object('folder', folder)
 
-    def upload_file(self, filename):
+    def move_folder_contents(self, src_id, dst_id):
+        """Moves all the waypoints and tracks in one folder to another.
+
+        This updates the destination folder with a single request,
+        regardless of the number of objects being moved. The source
+        folder is left in place (but empty, as far as the server is
+        concerned) for the caller to delete.
+
+        :param src_id: The id of the folder to move things out of
+        :type src_id: str
+        :param dst_id: The id of the folder to move things into
+        :type dst_id: str
+        :returns: The updated destination folder description, if
+                  successful, else ``None``
+        :rtype: `dict`
+        :raises NotFound: If either folder does not exist
+        """
+        # We need the list form of both folders, which we look up by id
+        # in one indexed pass. This has to be a fresh (not cached) list,
+        # since the source is often a just-created upload folder.
+        folders = index_by(self.list_objects('folder'), 'id')
+        try:
+            src = folders[src_id]
+            dst = folders[dst_id]
+        except KeyError as e:
+            raise NotFound('Item with id=%s not found' % e.args[0])
+
+        LOG.debug('Moving %i waypoints and %i tracks from %s to %s',
+                  len(src['waypoints']), len(src['tracks']), src_id, dst_id)
+        dst['waypoints'].extend(src['waypoints'])
+        dst['tracks'].extend(src['tracks'])
+
+        return self.put_object('folder', dst)
+
+    def upload_file(self, filename, fileobj=None):
         """Upload a file by name.
 
         :param filename: The local filename to upload
         :type filename: str
+        :param fileobj: An optional open binary file to upload instead of
+                        reading ``filename``, which then only provides the
+                        name
+        :type fileobj: file
         :returns: The resulting folder object that is created to hold the
                   contents of the file, as you would get from
                   :func:`~get_object`. None is returned if the server reports
                   that the upload was queued for processing.
         :rtype: `dict`
         """
-        files = {'files': open(filename, 'rb')}
+        if fileobj is None:
+            fileobj = open(filename, 'rb')
+        files = {'files': fileobj}
         name = os.path.basename(filename)
         r = self.s.post(gurl('upload'), files=files,
                         data={'name': name},
                         allow_redirects=True)
         _logresp(r)
+        self._drop_cache()
         if b'File uploaded to queue' in r.content:
             # This is unfortunately very  fragile, but there is not
             # much else we can do
@@ -400,6 +609,7 @@ class GaiaClient(object):
                        json={'deleted': archive,
                              objtype: ids})
         _logresp(r)
+        self._drop_cache()
         return r.status_code == 200
 
     def get_photo(self, photoid, size='fullsize'):
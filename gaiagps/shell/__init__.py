@@ -1,14 +1,16 @@
-import argparse
 import contextlib
 import getpass
 import http.cookiejar
 import logging
+import operator
 import os
 import sys
 import traceback
 
 from gaiagps import apiclient
 from gaiagps.shell import command
+from gaiagps.shell import daemon
+from gaiagps.shell import options
 from gaiagps.shell import photo
 from gaiagps.shell import upload
 from gaiagps.shell import track
@@ -16,6 +18,14 @@ from gaiagps.shell import folder
 from gaiagps.shell import waypoint
 
 
+_command_name = operator.attrgetter('__name__')
+
+# Commands, in the order they appear in help
+_COMMAND_CLASSES = sorted([waypoint.Waypoint, folder.Folder, command.Test,
+                           command.Tree, track.Track, upload.Upload,
+                           photo.Photo], key=_command_name)
+
+
 @contextlib.contextmanager
 def cookiejar():
     if sys.platform == 'win32':
@@ -23,18 +33,41 @@ def cookiejar():
     else:
         cookiepath = os.path.expanduser('~/.gaiagpsclient')
 
+    def snapshot():
+        return {(c.domain, c.path, c.name, c.value, c.expires) for c in jar}
+
     jar = http.cookiejar.LWPCookieJar(cookiepath)
     if os.path.exists(cookiepath):
         jar.load()
+        before = snapshot()
+    else:
+        before = None
 
     try:
         yield jar
     finally:
-        jar.save()
+        # Avoid rewriting the file if nothing changed
+        if snapshot() != before:
+            jar.save()
+
+
+def _command_classes():
+    if 'GAIAGPSCLIENTDEV' in os.environ:
+        return sorted(_COMMAND_CLASSES + [command.Query], key=_command_name)
+    return _COMMAND_CLASSES
 
 
-def main(args=None):
-    parser = argparse.ArgumentParser(
+def build_parser(command_classes=None):
+    """Build the argument parser for the command line client.
+
+    :param command_classes: The command classes to add, which defaults
+                            to all of the (enabled) commands
+    :returns: An argparse parser
+    """
+    if command_classes is None:
+        command_classes = _command_classes()
+
+    parser = options.LazyParser(
         description='Command line client for gaiagps.com')
     parser.add_argument('--user', help='Gaia username')
     parser.add_argument('--pass', metavar='PASS', dest='pass_',
@@ -43,28 +76,61 @@ def main(args=None):
                         action='store_true')
     parser.add_argument('--verbose', help='Enable verbose output',
                         action='store_true')
+    parser.add_argument('--daemon', action='store_true',
+                        help=('Stay running in the background and handle '
+                              'later commands, to avoid logging in each '
+                              'time (UNIX only)'))
 
-    cmds = parser.add_subparsers(dest='cmd')
+    # Each command's options are only added if that command is used
+    cmds = parser.add_subparsers(dest='cmd', parser_class=options.LazyParser)
+    for ccls in command_classes:
+        helptxt, desctxt = ccls._help_texts()
+        options.add_parser(cmds, ccls.__name__.lower(), ccls.opts,
+                           description=desctxt, help=helptxt)
 
-    command_classes = [waypoint.Waypoint, folder.Folder, command.Test,
-                       command.Tree, track.Track, upload.Upload,
-                       photo.Photo]
-    commands = {}
+    return parser
 
-    if 'GAIAGPSCLIENTDEV' in os.environ:
-        command_classes.append(command.Query)
-
-    for ccls in sorted(command_classes, key=lambda c: c.__name__):
-        command_name = ccls.__name__.lower()
-        commands[command_name] = ccls
-        try:
-            helptxt, desctxt = ccls.__doc__.split('\n', 1)
-        except ValueError:
-            helptxt = ccls.__doc__
-            desctxt = ''
-        ccls.opts(cmds.add_parser(command_name,
-                                  description=desctxt.strip(),
-                                  help=helptxt.strip()))
+
+def _wants_login(argv):
+    return any(a == '--user' or a.startswith('--user=') for a in argv)
+
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+def _save_cookies_unless_replaced(jar):
+    """Return a function that saves jar, unless its file has changed.
+
+    Someone else may log in (and save their cookies) while the daemon
+    runs, and we must not overwrite that with our older session.
+    """
+    mtime = _mtime(jar.filename)
+
+    def save():
+        if _mtime(jar.filename) == mtime:
+            jar.save()
+        else:
+            logging.getLogger('daemon').info(
+                'Cookie file changed; not saving ours')
+    return save
+
+
+def main(args=None, client=None):
+    if (args is None and '--daemon' not in sys.argv and
+            daemon.supported() and not _wants_login(sys.argv)):
+        # Let a running daemon handle this, if there is one. A new
+        # login is done here, so its cookies are saved by this process.
+        rc = daemon.forward(sys.argv)
+        if rc is not None:
+            return rc
+
+    command_classes = _command_classes()
+    commands = {ccls.__name__.lower(): ccls for ccls in command_classes}
+    parser = build_parser(command_classes)
 
     try:
         args = parser.parse_args(args)
@@ -81,12 +147,31 @@ def main(args=None):
     elif args.verbose:
         root_logger.setLevel(logging.INFO)
 
-    if not args.cmd:
+    if args.daemon:
+        if args.cmd:
+            print('--daemon does not take a command')
+            return 1
+        if not daemon.supported():
+            print('Daemon mode is not supported on this platform')
+            return 1
+        daemon_sock = daemon.listen()
+        if daemon_sock is None:
+            print('The gaiagps daemon is already running')
+            return 1
+    elif not args.cmd:
         parser.print_help()
         return 1
-    else:
-        is_terminal = os.isatty(sys.stdin.fileno())
-        if args.user and not args.pass_ and is_terminal:
+    elif (not getattr(args, 'subcommand', None) and
+            not hasattr(commands[args.cmd], 'default')):
+        # This would only print usage, so do not bother logging in
+        parser.print_usage()
+        return 0
+
+    # The daemon passes in its existing client, unless we were asked
+    # to use a different account
+    if client is None or args.user:
+        if (args.user and not args.pass_ and
+                os.isatty(sys.stdin.fileno())):
             args.pass_ = getpass.getpass()
 
         with cookiejar() as cookies:
@@ -97,10 +182,16 @@ def main(args=None):
                 print('Unable to access Gaia: %s' % e)
                 return 1
 
-        cmd = commands[args.cmd](client, verbose=args.verbose)
-        try:
-            return int(cmd.dispatch(parser, args) or 0)
-        except (apiclient.NotFound, RuntimeError) as e:
-            root_logger.debug(traceback.format_exc())
-            print(e)
-            return 1
+    if args.daemon:
+        return daemon.daemonize(daemon_sock,
+                                lambda argv: main(argv, client=client),
+                                cleanup=_save_cookies_unless_replaced(
+                                    client.s.cookies))
+
+    cmd = commands[args.cmd](client, verbose=args.verbose)
+    try:
+        return int(cmd.dispatch(parser, args) or 0)
+    except (apiclient.NotFound, RuntimeError) as e:
+        root_logger.debug(traceback.format_exc())
+        print(e)
+        return 1
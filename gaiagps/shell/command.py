@@ -1,3 +1,5 @@
+import concurrent.futures
+import json
 import logging
 import os
 import pprint
@@ -8,10 +10,22 @@ import sys
 import traceback
 import yaml
 
+try:
+    from yaml import CSafeDumper as SafeDumper
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeDumper
+    from yaml import SafeLoader
+
 from gaiagps import apiclient
 from gaiagps import util
 
 
+# Maximum number of concurrent requests we will make to the server
+# when fetching a batch of objects
+_MAX_WORKERS = 16
+
+
 class _Safety(Exception):
     pass
 
@@ -19,19 +33,81 @@ class _Safety(Exception):
 class Command(object):
     def __init__(self, client, verbose=False):
         self.client = client
+        self._date_cache = {}
+        self._folder_titles = {}
+        self._folder_lookups = 0
+        self._stdin_isatty = None
+        self._object_lists = {}
+        self._dumped_for_edit = None
         if verbose:
             self.verbose = lambda x, e=None: print(x, end=e)
         else:
             self.verbose = lambda x: None
 
-    @property
-    def objtype(self):
-        return self.__class__.__name__.lower()
+    # The API object type this command operates on, if any
+    objtype = None
+
+    # Number of folders we will fetch individually by id before deciding
+    # it is cheaper to just list all of them
+    _max_folder_lookups = 2
+
+    @classmethod
+    def _help_texts(cls):
+        """Return the help and description text for the command.
+
+        These are the first line and the rest of the class docstring,
+        respectively. They are worked out once per class and kept on it.
+        """
+        # Only look at this class itself, not a cached parent's copy
+        try:
+            return cls.__dict__['_help_texts_cache']
+        except KeyError:
+            pass
+        helptxt, _, desctxt = (cls.__doc__ or '').partition('\n')
+        cls._help_texts_cache = (helptxt.strip(), desctxt.strip())
+        return cls._help_texts_cache
 
     @staticmethod
     def opts(parser):
         pass
 
+    def _list_objects(self, objtype):
+        """Return the list of all objtype objects on the server.
+
+        The list is fetched once and reused for the rest of the command,
+        so that (for example) find_objects() and folder_filter() do not
+        both download the same thing.
+        """
+        try:
+            return self._object_lists[objtype]
+        except KeyError:
+            objs = self.client.list_objects(objtype)
+            self._object_lists[objtype] = objs
+            return objs
+
+    def _folder_title(self, ident):
+        """Return the title of a folder by id.
+
+        The first couple of folders are fetched individually, which is
+        cheaper than listing every folder when only one or two are
+        referenced. After that, all folders are listed once and cached,
+        rather than fetching each one in turn.
+        """
+        try:
+            return self._folder_titles[ident]
+        except KeyError:
+            pass
+
+        if self._folder_lookups < self._max_folder_lookups:
+            self._folder_lookups += 1
+            folder = self.client.get_object('folder', id_=ident)
+            self._folder_titles[ident] = folder['properties']['name']
+        else:
+            self._folder_titles.update(
+                {f['id']: f['title']
+                 for f in self._list_objects('folder')})
+        return self._folder_titles[ident]
+
     def folder_filter(self, name_or_id):
         """Return a function that will filter a list of items by folder, or
         generate all items in a folder.
@@ -54,7 +130,7 @@ class Command(object):
             if not items and folder_id is not None:
                 self.verbose('Generating list of items in folder %r' % (
                     name_or_id))
-                items = self.client.list_objects(self.objtype)
+                items = self._list_objects(self.objtype)
             for item in items:
                 if folder_id is None or item['folder'] == folder_id:
                     yield item
@@ -82,18 +158,29 @@ class Command(object):
     def find_objects(self, names_or_ids, objtype=None, match=False,
                      date_range=None, allow_missing=False):
         matched_objs = []
-        objs = self.client.list_objects(objtype or self.objtype)
+        objs = self._list_objects(objtype or self.objtype)
         if names_or_ids:
+            # Index the objects once so that each name or id is a
+            # dict lookup instead of a scan of the whole list. Titles
+            # are not unique, so let find() sort out the duplicates.
+            by_id = {}
+            by_title = {}
+            for obj in objs:
+                by_id.setdefault(obj['id'], []).append(obj)
+                by_title.setdefault(obj['title'], []).append(obj)
+
             for name_or_id in names_or_ids:
                 if util.is_id(name_or_id):
-                    matched_objs.append(apiclient.find(objs, 'id', name_or_id))
+                    matched_objs.append(apiclient.find(
+                        by_id.get(name_or_id, []), 'id', name_or_id))
                 elif match:
                     matched_objs.extend(apiclient.match(objs, 'title',
                                                         name_or_id))
                 else:
                     try:
-                        matched_objs.append(apiclient.find(objs, 'title',
-                                                           name_or_id))
+                        matched_objs.append(apiclient.find(
+                            by_title.get(name_or_id, []), 'title',
+                            name_or_id))
                     except apiclient.NotFound:
                         if not allow_missing:
                             raise
@@ -110,14 +197,41 @@ class Command(object):
 
         return matched_objs
 
+    def _get_full_objects(self, objs):
+        """Fetch the full definition of each object in objs.
+
+        The requests are issued concurrently, but the result is in the
+        same order as objs.
+        """
+        def _get(obj):
+            return self.client.get_object(self.objtype, id_=obj['id'])
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=_MAX_WORKERS) as pool:
+            return list(pool.map(_get, objs))
+
+    def _is_interactive(self):
+        """Return True if stdin is a terminal we can prompt on.
+
+        This is checked only once per command, regardless of how many
+        objects we end up asking about.
+        """
+        if self._stdin_isatty is None:
+            try:
+                self._stdin_isatty = os.isatty(sys.stdin.fileno())
+            except (OSError, ValueError):
+                # stdin is closed or not a real file
+                self._stdin_isatty = False
+        return self._stdin_isatty
+
     def _confirm_recursive(self, args, obj):
-        sub_objs = ('tracks', 'waypoints', 'children', 'maps')
-        if any(obj[o] for o in sub_objs):
+        if (obj['tracks'] or obj['waypoints'] or obj['children'] or
+                obj['maps']):
             if hasattr(args, 'force') and args.force:
                 self.verbose('Warning: folder %r is not empty' % (
                     obj['title']))
                 return True
-            elif os.isatty(sys.stdin.fileno()):
+            elif self._is_interactive():
                 answer = input(
                     'Folder %s is not empty. Remove anyway? [y/n] ' % (
                         obj['title']))
@@ -179,26 +293,30 @@ class Command(object):
             return 1
 
         if args.destination == '/':
-            for obj in folder_filter(to_move):
+            # Group by source folder so we update each folder only once
+            by_folder = {}
+            for obj in to_move:
                 if obj['folder']:
                     self.verbose('Moving %s %r (%s) to /' % (
                         objtype, obj['title'], obj['id']))
-                    if not args.dry_run:
-                        self.client.remove_object_from_folder(
-                            obj['folder'], objtype, obj['id'])
+                    by_folder.setdefault(obj['folder'], []).append(obj['id'])
                 else:
                     print('%s %r is already at root' % (
                         objtype.title(), obj['title']))
+            if not args.dry_run:
+                for folder_id, ids in by_folder.items():
+                    self.client.remove_objects_from_folder(
+                        folder_id, objtype, ids)
         else:
             folder = self.get_object(args.destination,
                                      objtype='folder')
-            for obj in folder_filter(to_move):
+            for obj in to_move:
                 self.verbose('Moving %s %r (%s) to %s' % (
                     objtype, obj['title'], obj['id'],
                     folder['properties']['name']))
-                if not args.dry_run:
-                    self.client.add_object_to_folder(
-                        folder['id'], objtype, obj['id'])
+            if not args.dry_run:
+                self.client.add_objects_to_folder(
+                    folder['id'], objtype, [obj['id'] for obj in to_move])
         if args.dry_run:
             print('Dry run; no action taken')
 
@@ -214,16 +332,24 @@ class Command(object):
     def idlist(self, args):
         objtype = self.objtype
         items = self.client.list_objects(objtype)
-        for item in items:
-            print('%-36s %20s %r' % (item['id'],
+        if items:
+            sys.stdout.write(''.join(
+                '%-36s %20s %r\n' % (item['id'],
                                      util.datefmt(item),
-                                     item['title']))
+                                     item['title'])
+                for item in items))
 
     def _match_date(self, item, date_range):
         start, end = date_range
-        item_dt = util.date_parse(item)
+        ds = util.get_datestamp(item)
+        try:
+            item_dt = self._date_cache[ds]
+        except KeyError:
+            item_dt = util.date_parse(item)
+            if item_dt:
+                item_dt = item_dt.replace(tzinfo=None)
+            self._date_cache[ds] = item_dt
         if item_dt:
-            item_dt = item_dt.replace(tzinfo=None)
             return item_dt >= start and item_dt <= end
         else:
             return False
@@ -263,13 +389,6 @@ class Command(object):
             return self.idlist(args)
 
         objtype = self.objtype
-        folders = {}
-
-        def get_folder(ident):
-            if not folders:
-                folders.update({f['id']: f
-                                for f in self.client.list_objects('folder')})
-            return folders[ident]
 
         if args.archived is not None:
             show_archived = args.archived
@@ -279,23 +398,26 @@ class Command(object):
             only_archived = False
 
         items = self.client.list_objects(objtype, archived=show_archived)
+        match_re = re.compile(args.match) if args.match else None
+
+        # Filter before looking up folder names and sorting, so that we
+        # only do that work for the items we are going to display.
+        items = [item for item in folder_filter(items)
+                 if ((not match_re or match_re.search(item['title'])) and
+                     (not args.match_date or
+                      self._match_date(item, args.match_date)) and
+                     (not only_archived or item['deleted']))]
         for item in items:
             folder = (item['folder'] and
-                      get_folder(item['folder'])['title'] or '')
+                      self._folder_title(item['folder']) or '')
             item['folder_name'] = folder
 
         table = prettytable.PrettyTable(['Name', 'Updated', 'Folder'])
 
         def sortkey(i):
-            return i['folder_name'] + ' ' + i['title']
+            return i['folder_name'], i['title']
 
-        for item in sorted(folder_filter(items), key=sortkey):
-            if args.match and not re.search(args.match, item['title']):
-                continue
-            if args.match_date and not self._match_date(item, args.match_date):
-                continue
-            if only_archived and not item['deleted']:
-                continue
+        for item in sorted(items, key=sortkey):
             if args.format:
                 # This is unfortunately very heavy, but since we do not seem to
                 # be able to get whole objects in list format, this is really
@@ -334,8 +456,8 @@ class Command(object):
             self.verbose('No items matched criteria')
             return 1
 
+        op = archive and 'Archiving' or 'Unarchiving'
         for item in to_hit:
-            op = archive and 'Archiving' or 'Unarchiving'
             self.verbose('%s %r' % (op, item['title']))
         if not args.dry_run:
             self.client.set_objects_archive(objtype,
@@ -366,6 +488,7 @@ class Command(object):
                 ('Internal error: unable to '
                  'find properties for object of type "%s"') % self.objtype)
 
+        only_keys = set(args.only_key)
         for k in args.only_key:
             if k not in props:
                 print('%s %r does not have key %r' % (
@@ -378,11 +501,13 @@ class Command(object):
             return 1
 
         if args.expand_key == ['all']:
-            args.expand_key = list(props.keys())
+            expand_keys = set(props.keys())
+        else:
+            expand_keys = set(args.expand_key)
 
         props = [(k, props[k])
                  for k in sorted(props.keys())
-                 if not args.only_key or k in args.only_key]
+                 if not only_keys or k in only_keys]
         if args.only_vals:
             for k, v in props:
                 if v:
@@ -395,9 +520,9 @@ class Command(object):
             table = prettytable.PrettyTable(['Key', 'Value'])
             table.align['Value'] = 'l'
             for k, v in props:
-                if isinstance(v, list) and k not in args.expand_key:
+                if isinstance(v, list) and k not in expand_keys:
                     v = '(%s items)' % len(v)
-                elif isinstance(v, dict) and k not in args.expand_key:
+                elif isinstance(v, dict) and k not in expand_keys:
                     v = '(%s keys)' % len(v.keys())
                 table.add_row((k, v))
             print(table)
@@ -429,8 +554,7 @@ class Command(object):
         ]
         """
         editable_objects = []
-        for obj in objs:
-            obj = self.client.get_object(self.objtype, id_=obj['id'])
+        for obj in self._get_full_objects(objs):
             editable_object = {}
             for path in editable:
                 # Pointer to which part of the object we have drilled
@@ -466,19 +590,24 @@ class Command(object):
                     parent = parent[element]
             editable_objects.append(editable_object)
 
+        # Remember what we wrote so that loading the edits back in this
+        # same run (i.e. interactive mode) can skip unchanged objects
+        self._dumped_for_edit = editable_objects
+
         if editable_objects:
             with open(temp_fn, 'w') as f:
                 f.write(os.linesep.join(['# %s' % line
                                          for line in self._edit_preamble()]))
                 f.write(os.linesep * 2)
-                f.write(yaml.dump(editable_objects, default_flow_style=False))
+                yaml.dump(editable_objects, f, Dumper=SafeDumper,
+                          default_flow_style=False)
         return len(editable_objects)
 
     def _load_for_edit(self, objs, editable, fn):
         # See definition of editable above in _dump_for_edit()
         log = logging.getLogger('shell_edit')
         with open(fn, 'r') as f:
-            editable_objects = yaml.load(f.read())
+            editable_objects = yaml.load(f, Loader=SafeLoader)
 
         if not isinstance(editable_objects, list):
             raise Exception('Input file format is incorrect. The top level '
@@ -490,8 +619,21 @@ class Command(object):
                  'server. Adding and deleting items via the edit process '
                  'is not supported.') % (len(editable_objects), len(objs)))
 
-        for i, editable_object in enumerate(editable_objects):
-            obj = self.client.get_object(self.objtype, id_=objs[i]['id'])
+        if self._dumped_for_edit is not None:
+            edited = [i for i, editable_object in enumerate(editable_objects)
+                      if editable_object != self._dumped_for_edit[i]]
+            log.debug('%i of %i objects were edited' % (
+                len(edited), len(editable_objects)))
+            if not edited:
+                print('No changes made; not updating')
+                return
+        else:
+            edited = range(len(editable_objects))
+
+        # Only fetch (and update) the objects that were actually edited
+        server_objects = self._get_full_objects([objs[i] for i in edited])
+        for i, obj in zip(edited, server_objects):
+            editable_object = editable_objects[i]
 
             # We stored the revision in the waypoint file,
             # and we are processing a stable ordering. Compare
@@ -615,15 +757,30 @@ class Tree(Command):
     This command will print all waypoints, tracks, and folders in a
     hierarchical layout, purely for visualization purposes.
     """
+
+    # Since this is just for looking at, a folder list this many seconds
+    # old is good enough
+    _cache_age = 60
+
     @staticmethod
     def opts(parser):
         parser.add_argument('--long', action='store_true',
                             help='Show long format with dates')
+        parser.add_argument('--no-cache', action='store_true',
+                            help=('Always fetch the folder list from the '
+                                  'server instead of using a recently '
+                                  'cached copy'))
 
     def default(self, args):
-        folders = self.client.list_objects('folder')
+        # The folder list already names the contents of each folder, so
+        # three lists are all we need, instead of fetching every folder
+        max_age = None if args.no_cache else self._cache_age
+        folders = self.client.list_objects('folder', max_age=max_age)
+        waypoints = self.client.list_objects('waypoint', max_age=max_age)
+        tracks = self.client.list_objects('track', max_age=max_age)
         root = util.make_tree(folders)
-        tree = util.resolve_tree(self.client, root)
+        tree = util.resolve_tree(self.client, root,
+                                 waypoints=waypoints, tracks=tracks)
         util.pprint_folder(tree, long=args.long)
 
 
@@ -650,9 +807,14 @@ class Query(Command):
                                   'only print content'))
 
     def default(self, args):
+        params = {}
+        for arg in args.args:
+            key, _, value = arg.partition('=')
+            params[key] = value
+
         method = getattr(self.client.s, args.method.lower())
-        r = method(apiclient.gurl(*args.path.split('/')),
-                   params=dict(x.split('=', 1) for x in args.args))
+        # gurl() strips the outer slashes, so the path can go in whole
+        r = method(apiclient.gurl(args.path), params=params)
         if not args.quiet:
             print('HTTP %i %s' % (r.status_code, r.reason))
             for h in r.headers:
@@ -660,6 +822,8 @@ class Query(Command):
             print()
 
         if 'json' in r.headers.get('Content-Type', ''):
-            pprint.pprint(r.json())
+            # Still pure Python with indent, but much quicker than pprint
+            # on big responses. Keys are sorted like pprint sorts them.
+            print(json.dumps(r.json(), indent=2, sort_keys=True))
         else:
             print(r.content)
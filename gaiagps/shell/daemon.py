@@ -0,0 +1,247 @@
+"""Optional background server for the command line client.
+
+Running ``gaiagps --daemon`` logs in once and then stays in the
+background, listening on a UNIX socket that only the current user can
+access. Later ``gaiagps`` invocations hand their arguments, environment
+and terminal over to it and let it run the command, which avoids a
+login check (and the cookie file handling) on every run.
+
+This is only available on platforms with UNIX sockets.
+"""
+
+import http.client
+import io
+import json
+import logging
+import os
+import socket
+import sys
+import time
+import traceback
+import tzlocal
+
+try:
+    from multiprocessing.reduction import recvfds
+    from multiprocessing.reduction import sendfds
+except ImportError:
+    recvfds = sendfds = None
+
+from gaiagps import util
+
+LOG = logging.getLogger(__name__)
+
+# Exit after this many seconds without a command to run
+IDLE_TIMEOUT = 600
+
+
+def socket_path():
+    return os.path.expanduser('~/.gaiagpsclient.sock')
+
+
+def supported():
+    return hasattr(socket, 'AF_UNIX') and sendfds is not None
+
+
+def forward(argv):
+    """Run a command in the daemon, if one is running.
+
+    Our stdin, stdout and stderr are passed to the daemon, so the command
+    behaves as if it were run here.
+
+    :param argv: The full command line, like sys.argv
+    :type argv: list
+    :returns: The exit code of the command, or None if no daemon is
+              running and the caller should run the command itself
+    """
+    path = socket_path()
+    if not os.path.exists(path):
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+
+    try:
+        fds = [sys.stdin.fileno(), sys.stdout.fileno(), sys.stderr.fileno()]
+    except (ValueError, io.UnsupportedOperation):
+        # Closed or replaced (like io.StringIO) streams have nothing to
+        # pass along, so run the command here instead
+        sock.close()
+        return None
+
+    with sock:
+        sendfds(sock, fds)
+        request = {'argv': argv,
+                   'cwd': os.getcwd(),
+                   'env': dict(os.environ)}
+        sock.sendall(json.dumps(request).encode() + b'\n')
+        with sock.makefile('rb') as f:
+            reply = f.readline()
+
+    try:
+        return int(reply)
+    except ValueError:
+        # The command may or may not have run, so do not try again
+        print('Lost connection to gaiagps daemon', file=sys.stderr)
+        return 1
+
+
+def _running(path):
+    """Return True if a daemon is listening on path."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        return False
+    else:
+        return True
+    finally:
+        sock.close()
+
+
+def listen():
+    """Create the daemon's listening socket.
+
+    :returns: A listening socket, or None if a daemon is already running
+    """
+    path = socket_path()
+    if _running(path):
+        return None
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o077)
+    try:
+        sock.bind(path)
+    finally:
+        os.umask(umask)
+    sock.listen(5)
+    return sock
+
+
+def _forget_environment():
+    """Drop anything cached from the previous command's environment."""
+    util.get_editor.cache_clear()
+    # Formatted dates depend on the local timezone
+    util._fmt_datestamp.cache_clear()
+    time.tzset()
+    tzlocal.reload_localzone()
+
+
+def handle(conn, main):
+    """Run one forwarded command from conn with main()."""
+    fds = recvfds(conn, 3)
+    with conn.makefile('rb') as f:
+        request = json.loads(f.readline().decode())
+
+    # main() turns these up for --debug or --verbose, and they must not
+    # stay that way for the next command
+    root_logger = logging.getLogger()
+    log_level = root_logger.level
+    http_debuglevel = http.client.HTTPConnection.debuglevel
+
+    # The same goes for the caller's command line, directory and
+    # environment, which we take on below
+    argv = sys.argv
+    cwd = os.getcwd()
+    environ = dict(os.environ)
+
+    # Point our stdin/stdout/stderr at the caller's, which also takes
+    # care of anything we spawn (like an editor)
+    saved = [os.dup(i) for i in range(3)]
+    try:
+        for i, fd in enumerate(fds):
+            os.dup2(fd, i)
+            os.close(fd)
+        os.chdir(request['cwd'])
+        os.environ.clear()
+        os.environ.update(request['env'])
+        _forget_environment()
+        # So that usage messages have the right program name
+        sys.argv = request['argv']
+        try:
+            rc = int(main(request['argv'][1:]) or 0)
+        except SystemExit as e:
+            if e.code is None:
+                rc = 0
+            elif isinstance(e.code, int):
+                rc = e.code
+            else:
+                rc = 1
+        except Exception:
+            traceback.print_exc()
+            rc = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for i, fd in enumerate(saved):
+            os.dup2(fd, i)
+            os.close(fd)
+        root_logger.setLevel(log_level)
+        http.client.HTTPConnection.debuglevel = http_debuglevel
+        sys.argv = argv
+        os.chdir(cwd)
+        os.environ.clear()
+        os.environ.update(environ)
+        _forget_environment()
+
+    conn.sendall(b'%i\n' % rc)
+
+
+def serve(sock, main, idle_timeout=IDLE_TIMEOUT):
+    """Run forwarded commands until we have been idle for idle_timeout."""
+    sock.settimeout(idle_timeout)
+    try:
+        while True:
+            try:
+                conn, _ = sock.accept()
+            except socket.timeout:
+                LOG.info('Idle for %s seconds; exiting' % idle_timeout)
+                break
+            with conn:
+                try:
+                    handle(conn, main)
+                except EOFError:
+                    # Someone just checking that we are running
+                    pass
+                except Exception:
+                    LOG.exception('Failed to handle request')
+    finally:
+        sock.close()
+        try:
+            os.unlink(socket_path())
+        except OSError:
+            pass
+
+
+def daemonize(sock, main, cleanup=None):
+    """Start the daemon in the background.
+
+    :param sock: The socket from listen()
+    :param main: Function to call with the argument list of each command
+    :param cleanup: Optional function the daemon calls before it exits
+    :returns: The exit code for the foreground process
+    """
+    pid = os.fork()
+    if pid:
+        sock.close()
+        print('Started gaiagps daemon (pid %i)' % pid)
+        return 0
+
+    os.setsid()
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for i in range(3):
+        os.dup2(devnull, i)
+    os.close(devnull)
+    try:
+        serve(sock, main)
+        if cleanup:
+            cleanup()
+    finally:
+        os._exit(0)
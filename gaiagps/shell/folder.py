@@ -11,6 +11,9 @@ class Folder(command.Command):
     This command allows you to take action on folders, such as
     adding, removing, and moving them.
     """
+
+    objtype = 'folder'
+
     @staticmethod
     def opts(parser):
         cmds = parser.add_subparsers(dest='subcommand')
@@ -20,9 +23,10 @@ class Folder(command.Command):
                          help=('Do not actually add anything '
                                '(use with --verbose)'))
         options.folder_ops(add, allownew=False)
-        remove = options.remove_ops(cmds, 'folder')
-        remove.add_argument('--force', action='store_true',
-                            help='Remove even if not empty')
+        options.defer(options.remove_ops(cmds, 'folder'),
+                      lambda remove: remove.add_argument(
+                          '--force', action='store_true',
+                          help='Remove even if not empty'))
         access = cmds.add_parser('access', help='Manage access (sharing)')
         access.add_argument('--list', action='store_true',
                             help='List information about users with access')
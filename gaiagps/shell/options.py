@@ -12,35 +12,123 @@ def folder_ops(parser, allownew=True):
                             help='Add to a new folder with this name')
 
 
+class LazyParser(argparse.ArgumentParser):
+    """An ArgumentParser that adds its arguments on first use.
+
+    Builders registered with defer() are run just before the parser is
+    needed to parse arguments or format help/usage. A command with many
+    subcommands then only pays for building the one that was requested.
+
+    This also reuses a single formatter for the sanity checks argparse
+    does in add_argument(), instead of creating (and querying the
+    terminal size for) a new one for every argument.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._builders = []
+        self._adding_argument = False
+        self._add_argument_formatter = None
+        super().__init__(*args, **kwargs)
+
+    def _get_formatter(self):
+        if not self._adding_argument:
+            # Formatting help accumulates state, so needs a fresh one
+            return super()._get_formatter()
+        if self._add_argument_formatter is None:
+            self._add_argument_formatter = super()._get_formatter()
+        return self._add_argument_formatter
+
+    def add_argument(self, *args, **kwargs):
+        self._adding_argument = True
+        try:
+            return super().add_argument(*args, **kwargs)
+        finally:
+            self._adding_argument = False
+
+    def _build(self):
+        while self._builders:
+            self._builders.pop(0)(self)
+
+    def parse_known_args(self, args=None, namespace=None):
+        self._build()
+        return super().parse_known_args(args, namespace)
+
+    def format_usage(self):
+        self._build()
+        return super().format_usage()
+
+    def format_help(self):
+        self._build()
+        return super().format_help()
+
+
+def defer(parser, builder):
+    """Call builder(parser) when parser is first used.
+
+    If parser is not a LazyParser, builder is called immediately.
+    """
+    if isinstance(parser, LazyParser):
+        parser._builders.append(builder)
+    else:
+        builder(parser)
+    return parser
+
+
+def add_parser(cmds, name, builder, **kwargs):
+    """Add a subcommand parser whose arguments are added by builder."""
+    return defer(cmds.add_parser(name, **kwargs), builder)
+
+
+def _parse_date(date_str):
+    """Parse a YYYY-MM-DD string into a datetime.
+
+    This is much cheaper than strptime() for our one fixed format. Only
+    strings made of plain digit fields of the widths strptime() takes
+    use the fast path, since int() also accepts things like signs and
+    whitespace. Everything else goes to strptime(), so the set of
+    accepted strings does not change.
+    """
+    parts = date_str.split('-')
+    if len(parts) == 3:
+        year, month, day = parts
+        if (len(year) == 4 and len(month) in (1, 2) and len(day) in (1, 2)
+                and year.isdigit() and month.isdigit() and day.isdigit()):
+            try:
+                return datetime.datetime(int(year), int(month), int(day))
+            except ValueError:
+                pass
+    return datetime.datetime.strptime(date_str, '%Y-%m-%d')
+
+
 class DateRange(argparse.Action):
+    # End date is inclusive, so make it 23:59:59
+    _end_of_day = datetime.timedelta(hours=23, minutes=59, seconds=59)
+
     def __call__(self, parser, namespace, values, option_string=None):
         try:
-            fmt = '%Y-%m-%d'
             dates = values.split(':', 1)
-            start = datetime.datetime.strptime(dates[0], fmt)
+            start = _parse_date(dates[0])
             if len(dates) > 1:
                 # End was specified
-                end = datetime.datetime.strptime(dates[1], fmt)
+                end = _parse_date(dates[1])
             else:
-                # No end, so re-parse start so we get another object
-                # we can mutate below
-                end = datetime.datetime.strptime(dates[0], fmt)
-
-            # End date is inclusive, so make it 23:59:59
-            end = (end +
-                   datetime.timedelta(hours=24) -
-                   datetime.timedelta(seconds=1))
+                end = start
 
-            setattr(namespace, self.dest, (start, end))
+            setattr(namespace, self.dest, (start, end + self._end_of_day))
         except ValueError:
             raise argparse.ArgumentError(self, 'Invalid date format')
 
 
+_TRUE_VALUES = frozenset(('y', 'yes', 't', 'true'))
+_FALSE_VALUES = frozenset(('n', 'no', 'f', 'false'))
+
+
 class FuzzyBoolean(argparse.Action):
     def __call__(self, parser, namespace, values, option_string=None):
-        if values and values.lower() in ['y', 'yes', 't', 'true']:
+        value = values and values.lower()
+        if value in _TRUE_VALUES:
             setattr(namespace, self.dest, True)
-        elif values and values.lower() in ['n', 'no', 'f', 'false']:
+        elif value in _FALSE_VALUES:
             setattr(namespace, self.dest, False)
         else:
             raise argparse.ArgumentError(
@@ -48,121 +136,147 @@ class FuzzyBoolean(argparse.Action):
 
 
 def remove_ops(cmds, objtype):
-    remove = cmds.add_parser(
-        'remove', help='Remove a %s' % objtype,
+    def build(remove):
+        remove.add_argument('--match', action='store_true',
+                            help=('Treat names as regular expressions and '
+                                  'include all matches'))
+        remove.add_argument('--dry-run', action='store_true',
+                            help=('Do not actually remove anything '
+                                  '(use with --verbose)'))
+        remove.add_argument('--in-folder',
+                            help='Limit to items in this folder')
+        remove.add_argument('name', help='Name (or ID)', nargs='*')
+
+    return add_parser(
+        cmds, 'remove', build, help='Remove a %s' % objtype,
         description='Delete %s objects from the server forever' % objtype)
-    remove.add_argument('--match', action='store_true',
-                        help=('Treat names as regular expressions and include '
-                              'all matches'))
-    remove.add_argument('--dry-run', action='store_true',
-                        help=('Do not actually remove anything '
-                              '(use with --verbose)'))
-    remove.add_argument('--in-folder',
-                        help='Limit to items in this folder')
-    remove.add_argument('name', help='Name (or ID)', nargs='*')
-    return remove
 
 
 def move_ops(cmds):
-    move = cmds.add_parser('move', help='Move to another folder',
-                           description='Move objects into a folder')
-    move.add_argument('--match', action='store_true',
-                      help=('Treat names as regular expressions and include '
-                            'all matches'))
-    move.add_argument('--match-date', metavar='YYYY-MM-DD',
-                      action=DateRange,
-                      help=('Match items with this date. Specify an '
-                            'inclusive range with START:END.'))
-    move.add_argument('--dry-run', action='store_true',
-                      help=('Do not actually move anything '
-                            '(use with --verbose)'))
-    move.add_argument('--in-folder',
-                      help='Limit to items in this folder')
-    move.add_argument('name', help='Name (or ID)', nargs='*')
-    move.add_argument('destination',
-                      help='Destination folder (or "/" to move to root)')
+    def build(move):
+        move.add_argument('--match', action='store_true',
+                          help=('Treat names as regular expressions and '
+                                'include all matches'))
+        move.add_argument('--match-date', metavar='YYYY-MM-DD',
+                          action=DateRange,
+                          help=('Match items with this date. Specify an '
+                                'inclusive range with START:END.'))
+        move.add_argument('--dry-run', action='store_true',
+                          help=('Do not actually move anything '
+                                '(use with --verbose)'))
+        move.add_argument('--in-folder',
+                          help='Limit to items in this folder')
+        move.add_argument('name', help='Name (or ID)', nargs='*')
+        move.add_argument('destination',
+                          help='Destination folder (or "/" to move to root)')
+
+    add_parser(cmds, 'move', build, help='Move to another folder',
+               description='Move objects into a folder')
 
 
 def rename_ops(cmds):
-    rename = cmds.add_parser('rename', help='Rename',
-                             description='Rename objects on the server')
-    rename.add_argument('--dry-run', action='store_true',
-                        help=('Do not actually rename anything '
-                              '(use with --verbose)'))
-    rename.add_argument('name', help='Current name')
-    rename.add_argument('new_name', help='New name')
+    def build(rename):
+        rename.add_argument('--dry-run', action='store_true',
+                            help=('Do not actually rename anything '
+                                  '(use with --verbose)'))
+        rename.add_argument('name', help='Current name')
+        rename.add_argument('new_name', help='New name')
+
+    add_parser(cmds, 'rename', build, help='Rename',
+               description='Rename objects on the server')
 
 
 def export_ops(cmds):
-    export = cmds.add_parser(
-        'export', help='Export to file',
-        description='Export objects into a local GPX or KML file')
-    export.add_argument('name', help='Name (or ID)')
-    export.add_argument('filename', help='Export filename (or - for stdout)')
-    export.add_argument('--format', default='gpx', choices=('gpx', 'kml'),
-                        help='File format (default=gpx)')
+    def build(export):
+        export.add_argument('name', help='Name (or ID)')
+        export.add_argument('filename',
+                            help='Export filename (or - for stdout)')
+        export.add_argument('--format', default='gpx', choices=('gpx', 'kml'),
+                            help='File format (default=gpx)')
+
+    add_parser(cmds, 'export', build, help='Export to file',
+               description='Export objects into a local GPX or KML file')
 
 
 def list_and_dump_ops(cmds):
-    list = cmds.add_parser('list', help='List',
-                           description='List objects on the server')
-    list.add_argument('--by-id', action='store_true',
-                      help='List items by ID only (for resolving duplicates')
-    list.add_argument('--match', metavar='NAME',
-                      help='List only items matching this regular expression')
-    list.add_argument('--match-date', metavar='YYYY-MM-DD',
-                      action=DateRange,
-                      help=('Match items with this date. Specify an '
-                            'inclusive range with START:END.'))
-    list.add_argument('--archived', action=FuzzyBoolean,
-                      help='Match items with archived state ("yes" or "no")')
-    list.add_argument('--format',
-                      help=('Set explicit output format instead of default '
-                            'table layout. Use --format=help for '
-                            'instructions'))
-    list.add_argument('--in-folder',
-                      help='Limit to items in this folder')
-    dump = cmds.add_parser('dump', help='Raw dump of the data structure',
-                           description=('Dump the low-level representation of '
-                                        'an object on the server '
-                                        '(for debugging)'))
-    dump.add_argument('name', help='Name (or ID)')
-
-    urlfor = cmds.add_parser('url', help='Show direct browser-suitable URL')
-    urlfor.add_argument('name', help='Name (or ID)')
+    def build_list(list):
+        list.add_argument('--by-id', action='store_true',
+                          help=('List items by ID only (for resolving '
+                                'duplicates'))
+        list.add_argument('--match', metavar='NAME',
+                          help=('List only items matching this regular '
+                                'expression'))
+        list.add_argument('--match-date', metavar='YYYY-MM-DD',
+                          action=DateRange,
+                          help=('Match items with this date. Specify an '
+                                'inclusive range with START:END.'))
+        list.add_argument('--archived', action=FuzzyBoolean,
+                          help=('Match items with archived state '
+                                '("yes" or "no")'))
+        list.add_argument('--format',
+                          help=('Set explicit output format instead of '
+                                'default table layout. Use --format=help '
+                                'for instructions'))
+        list.add_argument('--in-folder',
+                          help='Limit to items in this folder')
+
+    def build_name(parser):
+        parser.add_argument('name', help='Name (or ID)')
+
+    add_parser(cmds, 'list', build_list, help='List',
+               description='List objects on the server')
+    add_parser(cmds, 'dump', build_name,
+               help='Raw dump of the data structure',
+               description=('Dump the low-level representation of '
+                            'an object on the server '
+                            '(for debugging)'))
+    add_parser(cmds, 'url', build_name,
+               help='Show direct browser-suitable URL')
 
 
 def archive_ops(cmds):
-    archive = cmds.add_parser(
-        'archive',
-        help='Archive (set sync=off)',
-        description=('Archive an object on the server '
-                     '(so that it does not sync to devices'))
-    unarchive = cmds.add_parser(
-        'unarchive',
-        help='Unarchive (set sync=on)',
-        description=('Unarchive an object on the server '
-                     '(so that it does sync to devices)'))
-    for i in (archive, unarchive):
-        i.add_argument('name', nargs='*',
-                       help='Name (or ID)')
-        i.add_argument('--match', action='store_true',
-                       help=('Treat names as regular expressions and include '
-                             'all matches'))
-        i.add_argument('--match-date', metavar='YYYY-MM-DD',
-                       action=DateRange,
-                       help=('Match items with this date. Specify an '
-                             'inclusive range with START:END.'))
-        i.add_argument('--dry-run', action='store_true',
-                       help=('Do not actually change anything '
-                             '(use with --verbose)'))
-        i.add_argument('--in-folder',
-                       help='Limit to items in this folder')
+    def build(parser):
+        parser.add_argument('name', nargs='*',
+                            help='Name (or ID)')
+        parser.add_argument('--match', action='store_true',
+                            help=('Treat names as regular expressions and '
+                                  'include all matches'))
+        parser.add_argument('--match-date', metavar='YYYY-MM-DD',
+                            action=DateRange,
+                            help=('Match items with this date. Specify an '
+                                  'inclusive range with START:END.'))
+        parser.add_argument('--dry-run', action='store_true',
+                            help=('Do not actually change anything '
+                                  '(use with --verbose)'))
+        parser.add_argument('--in-folder',
+                            help='Limit to items in this folder')
+
+    add_parser(cmds, 'archive', build,
+               help='Archive (set sync=off)',
+               description=('Archive an object on the server '
+                            '(so that it does not sync to devices'))
+    add_parser(cmds, 'unarchive', build,
+               help='Unarchive (set sync=on)',
+               description=('Unarchive an object on the server '
+                            '(so that it does sync to devices)'))
 
 
 def edit_ops(cmds):
-    edit = cmds.add_parser(
-        'edit',
+    def build(edit):
+        edit.add_argument('name', help='Name (or ID)', nargs='*')
+        if util.get_editor():
+            edit.add_argument('-i', '--interactive', action='store_true',
+                              help='Interactively edit properties')
+        edit.add_argument('-f', '--file',
+                          help='Apply edits from a file')
+        edit.add_argument('--match', action='store_true',
+                          help=('Treat names as regular expressions and '
+                                'include all matches'))
+        edit.add_argument('--in-folder',
+                          help='Only edit items in this folder')
+
+    add_parser(
+        cmds, 'edit', build,
         help='Edit all attributes of one or more items',
         description=("""
         This command will download one or more items into
@@ -179,35 +293,25 @@ def edit_ops(cmds):
         `gaiagps waypoint edit -i Camp1 Camp2`
         """))
 
-    edit.add_argument('name', help='Name (or ID)', nargs='*')
-    if util.get_editor():
-        edit.add_argument('-i', '--interactive', action='store_true',
-                          help='Interactively edit properties')
-    edit.add_argument('-f', '--file',
-                      help='Apply edits from a file')
-    edit.add_argument('--match', action='store_true',
-                      help=('Treat names as regular expressions and include '
-                            'all matches'))
-    edit.add_argument('--in-folder',
-                      help='Only edit items in this folder')
-
 
 def show_ops(cmds):
-    show = cmds.add_parser(
-        'show',
+    def build(show):
+        show.add_argument('name',
+                          help='Name (or ID)')
+        show.add_argument('--field-separator', '-f',
+                          help=('Specify a string to separate the key=value '
+                                'fields for easier parsing'))
+        show.add_argument('--only-key', '-K', default=[], action='append',
+                          help=('Only display these keys (specify multiple '
+                                'times for multiple keys)'))
+        show.add_argument('--expand-key', '-k', default=[], action='append',
+                          help=('Expand these keys (specify multiple times '
+                                'for multiple keys) to their full values '
+                                '(or \'all\')'))
+        show.add_argument('--only-vals', '-V', action='store_true',
+                          help=('Only show values'))
+
+    add_parser(
+        cmds, 'show', build,
         help='Show all available details for a single item',
         description='Show all available details about an item')
-    show.add_argument('name',
-                      help='Name (or ID)')
-    show.add_argument('--field-separator', '-f',
-                      help=('Specify a string to separate the key=value '
-                            'fields for easier parsing'))
-    show.add_argument('--only-key', '-K', default=[], action='append',
-                      help=('Only display these keys (specify multiple '
-                            'times for multiple keys)'))
-    show.add_argument('--expand-key', '-k', default=[], action='append',
-                      help=('Expand these keys (specify multiple times '
-                            'for multiple keys) to their full values '
-                            '(or \'all\')'))
-    show.add_argument('--only-vals', '-V', action='store_true',
-                      help=('Only show values'))
@@ -20,6 +20,9 @@ class Photo(command.Command):
     them. Note that GaiaGPS.com treats photos mostly as waypoints, so
     you should use the waypoint command to move, rename, and delete them.
     """
+
+    objtype = 'photo'
+
     @staticmethod
     def opts(parser):
         cmds = parser.add_subparsers(dest='subcommand')
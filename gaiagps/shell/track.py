@@ -15,6 +15,8 @@ class Track(command.Command):
     removing, and renaming them.
     """
 
+    objtype = 'track'
+
     _editable_properties = ('color', 'notes', 'public', 'title', 'revision')
 
     @staticmethod
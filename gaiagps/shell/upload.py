@@ -1,3 +1,4 @@
+import io
 import logging
 import os
 import sys
@@ -59,12 +60,14 @@ class Upload(command.Command):
         log = logging.getLogger('upload')
 
         if args.strip_gpx_extensions:
-            tmpfile = os.path.join(
-                os.path.dirname(args.filename),
-                'clean-%s' % os.path.basename(args.filename))
+            # Keep the cleaned copy in memory instead of leaving a file
+            # next to the original
             self.verbose('Stripping GPX extensions from input file')
-            util.strip_gpx_extensions(args.filename, tmpfile)
-            args.filename = tmpfile
+            cleaned = io.BytesIO()
+            util.strip_gpx_extensions(args.filename, cleaned)
+            cleaned.seek(0)
+        else:
+            cleaned = None
 
         if args.existing_folder:
             dst_folder = self.get_object(args.existing_folder,
@@ -72,7 +75,11 @@ class Upload(command.Command):
         else:
             dst_folder = None
 
-        new_folder = self.client.upload_file(args.filename)
+        if cleaned is not None:
+            new_folder = self.client.upload_file(args.filename,
+                                                 fileobj=cleaned)
+        else:
+            new_folder = self.client.upload_file(args.filename)
 
         if not new_folder and args.poll:
             new_folder = self._poll_for_upload(os.path.basename(args.filename))
@@ -86,9 +93,8 @@ class Upload(command.Command):
             return
 
         log.debug(new_folder)
-        log.info('Uploaded file to new folder %s/%s' % (
-            new_folder['properties']['name'],
-            new_folder['id']))
+        log.info('Uploaded file to new folder %s/%s',
+                 new_folder['properties']['name'], new_folder['id'])
 
         if args.colorize_tracks:
             track_cmd = track.Track(self.client, verbose=args.verbose)
@@ -114,30 +120,22 @@ class Upload(command.Command):
                 return 1
 
         if dst_folder:
-            # I want that...other version of a folder
-            folders = self.client.list_objects('folder')
-            new_folder_desc = apiclient.find(folders, 'id', new_folder['id'])
-            dst_folder_desc = apiclient.find(folders, 'id', dst_folder['id'])
-
-            log.info('Moving contents of %s to %s' % (
-                new_folder['properties']['name'],
-                dst_folder['properties']['name']))
-
-            for waypoint in new_folder_desc['waypoints']:
-                log.info('Moving waypoint %s' % waypoint)
-                dst_folder_desc['waypoints'].append(waypoint)
-            for t in new_folder_desc['tracks']:
-                log.info('Moving track %s' % t)
-                dst_folder_desc['tracks'].append(t)
-            updated_dst = self.client.put_object('folder', dst_folder_desc)
-            log.info('Updated destination folder %s' % (
-                dst_folder['properties']['name']))
+            log.info('Moving contents of %s to %s',
+                     new_folder['properties']['name'],
+                     dst_folder['properties']['name'])
+            updated_dst = self.client.move_folder_contents(new_folder['id'],
+                                                           dst_folder['id'])
+            log.info('Updated destination folder %s',
+                     dst_folder['properties']['name'])
             if not updated_dst:
                 print('Failed to move tracks and waypoints from '
                       'upload folder %s to requested folder %s' % (
                           new_folder['properties']['name'],
                           dst_folder['properties']['name']))
                 return 1
-            log.info('Deleting temporary folder %s' % (
-                new_folder['properties']['name']))
+            # Only delete the upload folder once we know its contents
+            # made it into the destination; running this alongside the
+            # move above could lose data if the move fails.
+            log.info('Deleting temporary folder %s',
+                     new_folder['properties']['name'])
             self.client.delete_object('folder', new_folder['id'])
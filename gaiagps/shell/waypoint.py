@@ -12,22 +12,48 @@ class Waypoint(command.Command):
     This command allows you to take action on waypoints, such as adding,
     removing, and renaming them.
     """
+
+    objtype = 'waypoint'
+
     @staticmethod
     def opts(parser):
-        cmds = parser.add_subparsers(dest='subcommand')
-        add = cmds.add_parser('add', help='Add a waypoint')
-        add.add_argument('name', help='Name (or ID)')
-        add.add_argument('latitude', help='Latitude (in decimal degrees)')
-        add.add_argument('longitude', help='Longitude (in decimal degrees)')
-        add.add_argument('altitude', help='Altitude (in meters', default=0,
-                         nargs='?')
-        add.add_argument('--notes', help='Set the notes field', default='')
-        add.add_argument('--icon', help='Set the icon field', default='')
-        add.add_argument('--dry-run', action='store_true',
-                         help=('Do not actually add anything '
-                               '(use with --verbose)'))
+        cmds = parser.add_subparsers(dest='subcommand',
+                                     parser_class=options.LazyParser)
+
+        def build_add(add):
+            add.add_argument('name', help='Name (or ID)')
+            add.add_argument('latitude', help='Latitude (in decimal degrees)')
+            add.add_argument('longitude',
+                             help='Longitude (in decimal degrees)')
+            add.add_argument('altitude', help='Altitude (in meters',
+                             default=0, nargs='?')
+            add.add_argument('--notes', help='Set the notes field',
+                             default='')
+            add.add_argument('--icon', help='Set the icon field', default='')
+            add.add_argument('--dry-run', action='store_true',
+                             help=('Do not actually add anything '
+                                   '(use with --verbose)'))
+            options.folder_ops(add)
+
+        def build_coords(coords):
+            coords.add_argument('name', help='Name (or ID)', nargs='*')
+            coords.add_argument('--match', action='store_true',
+                                help=('Treat names as regular expressions '
+                                      'and include all matches'))
+            coords.add_argument('--in-folder',
+                                help='Limit to items in this folder')
+            coords.add_argument('--just-one', action='store_true',
+                                help=('Fail if more than one match is found '
+                                      '(useful in a script when the output '
+                                      'needs to be asserted as a single '
+                                      'lat,lon)'))
+            coords.add_argument('--show-name', action='store_true',
+                                help=('Show the waypoint name after the '
+                                      'coordinates, separated by a single '
+                                      'space'))
+
+        options.add_parser(cmds, 'add', build_add, help='Add a waypoint')
         options.edit_ops(cmds)
-        options.folder_ops(add)
         options.remove_ops(cmds, 'waypoint')
         options.move_ops(cmds)
         options.rename_ops(cmds)
@@ -38,21 +64,8 @@ class Waypoint(command.Command):
 
         cmds.add_parser('list-icons',
                         help='List available icons')
-
-        coords = cmds.add_parser('coords', help='Display coordinates')
-        coords.add_argument('name', help='Name (or ID)', nargs='*')
-        coords.add_argument('--match', action='store_true',
-                            help=('Treat names as regular expressions and '
-                                  'include all matches'))
-        coords.add_argument('--in-folder',
-                            help='Limit to items in this folder')
-        coords.add_argument('--just-one', action='store_true',
-                            help=('Fail if more than one match is found '
-                                  '(useful in a script when the output needs '
-                                  'to be asserted as a single lat,lon)'))
-        coords.add_argument('--show-name', action='store_true',
-                            help=('Show the waypoint name after the '
-                                  'coordinates, separated by a single space'))
+        options.add_parser(cmds, 'coords', build_coords,
+                           help='Display coordinates')
 
     def list_icons(self, args):
         for alias, filename in util.ICON_ALIASES.items():
@@ -73,8 +86,10 @@ class Waypoint(command.Command):
         else:
             folder = None
 
-        if args.icon and args.icon in util.ICON_ALIASES:
-            args.icon = util.ICON_ALIASES[args.icon]
+        if args.icon:
+            # Gaia has more icons than we have aliases for, so pass
+            # unknown ones along as-is
+            args.icon = util.canonical_icon(args.icon) or args.icon
 
         self.verbose('Creating waypoint %r' % args.name)
         if not args.dry_run:
@@ -151,15 +166,14 @@ class Waypoint(command.Command):
                               ' '.join(util.ICON_ALIASES.keys())))
 
     def _edit_preprocess(self, obj):
-        icon_rev = {v: k for k, v in util.ICON_ALIASES.items()}
+        icon_rev = util.ICON_NAMES
         obj['properties']['icon'] = icon_rev.get(obj['properties']['icon'],
                                                  obj['properties']['icon'])
         return obj
 
     def _edit_postprocess(self, obj):
-        icon_fwd = util.ICON_ALIASES
-        obj['properties']['icon'] = icon_fwd.get(obj['properties']['icon'],
-                                                 obj['properties']['icon'])
+        icon = obj['properties']['icon']
+        obj['properties']['icon'] = util.canonical_icon(icon) or icon
         return obj
 
     def edit(self, args):
@@ -1,4 +1,6 @@
 import http.cookiejar
+import io
+import json
 import mock
 import os
 import tempfile
@@ -144,6 +146,16 @@ class TestClientUnit(unittest.TestCase):
         obj = api.put_object('waypoint', {'name': 'foo', 'id': '1'})
         self.assertIsNone(obj)
 
+    @mock.patch('pprint.pformat')
+    def test_put_object_no_debug_formatting(self, mock_pformat):
+        api = self.get_api()
+
+        self.requests.put.return_value.status_code = 201
+        with mock.patch.object(apiclient.LOG, 'isEnabledFor',
+                               return_value=False):
+            api.put_object('waypoint', {'name': 'foo', 'id': '1'})
+        mock_pformat.assert_not_called()
+
     def test_delete_object(self):
         api = self.get_api()
 
@@ -187,6 +199,54 @@ class TestClientUnit(unittest.TestCase):
                       'children': ['folder2'],
                       'waypoints': ['2', 'waypoint1']})
 
+    def test_add_objects_to_folder(self):
+        api = self.get_api()
+
+        with mock.patch.object(api, 'list_objects') as mock_list:
+            self.requests.put.return_value.status_code = 201
+            mock_list.return_value = [
+                {'id': 'folder1', 'name': 'My Folder',
+                 'waypoints': ['2'], 'children': []},
+            ]
+
+            folder = api.add_objects_to_folder(
+                'folder1', 'waypoint', ['waypoint1', 'waypoint2'])
+            self.assertEqual(self.requests.put.return_value.json.return_value,
+                             folder)
+            self.requests.put.assert_called_once_with(
+                apiclient.gurl('api', 'objects', 'folder', 'folder1'),
+                json={'id': 'folder1', 'name': 'My Folder',
+                      'children': [],
+                      'waypoints': ['2', 'waypoint1', 'waypoint2']})
+
+    def test_move_folder_contents(self):
+        api = self.get_api()
+
+        with mock.patch.object(api, 'list_objects') as mock_list:
+            self.requests.put.return_value.status_code = 201
+            mock_list.return_value = [
+                {'id': 'folder1', 'waypoints': ['1'], 'tracks': []},
+                {'id': 'folder2', 'waypoints': ['2', '3'], 'tracks': ['4']},
+            ]
+
+            folder = api.move_folder_contents('folder2', 'folder1')
+            self.assertEqual(self.requests.put.return_value.json.return_value,
+                             folder)
+            mock_list.assert_called_once_with('folder')
+            self.requests.put.assert_called_once_with(
+                apiclient.gurl('api', 'objects', 'folder', 'folder1'),
+                json={'id': 'folder1',
+                      'waypoints': ['1', '2', '3'],
+                      'tracks': ['4']})
+
+            self.assertRaises(apiclient.NotFound,
+                              api.move_folder_contents, 'folder2', 'nope')
+            self.assertRaises(apiclient.NotFound,
+                              api.move_folder_contents, 'nope', 'folder1')
+            # One list per move, never from the on-disk cache
+            for call in mock_list.call_args_list:
+                self.assertEqual(mock.call('folder'), call)
+
     def test_add_object_to_folder_failures(self):
         api = self.get_api()
 
@@ -230,6 +290,26 @@ class TestClientUnit(unittest.TestCase):
                       'children': [],
                       'waypoints': []})
 
+    def test_remove_objects_from_folder(self):
+        api = self.get_api()
+
+        with mock.patch.object(api, 'list_objects') as mock_list:
+            self.requests.put.return_value.status_code = 201
+            mock_list.return_value = [
+                {'id': 'folder1', 'name': 'My Folder',
+                 'waypoints': ['1', '2', '3'], 'children': []},
+            ]
+
+            folder = api.remove_objects_from_folder(
+                'folder1', 'waypoint', ['1', '3'])
+            self.assertEqual(self.requests.put.return_value.json.return_value,
+                             folder)
+            self.requests.put.assert_called_once_with(
+                apiclient.gurl('api', 'objects', 'folder', 'folder1'),
+                json={'id': 'folder1', 'name': 'My Folder',
+                      'children': [],
+                      'waypoints': ['2']})
+
     def test_remove_object_from_folder_failures(self):
         api = self.get_api()
 
@@ -256,6 +336,21 @@ class TestClientUnit(unittest.TestCase):
                 allow_redirects=True)
             mock_open.assert_called_once_with('path/to/foo.gpx', 'rb')
 
+    @mock.patch('builtins.open')
+    def test_upload_fileobj(self, mock_open):
+        api = self.get_api()
+
+        fileobj = io.BytesIO(b'<gpx/>')
+        self.requests.post.return_value.url = '/foo/newfolderid/'
+        with mock.patch.object(api, 'get_object'):
+            api.upload_file('path/to/foo.gpx', fileobj=fileobj)
+            self.requests.post.assert_called_once_with(
+                apiclient.gurl('upload'),
+                files={'files': fileobj},
+                data={'name': 'foo.gpx'},
+                allow_redirects=True)
+            mock_open.assert_not_called()
+
     @mock.patch('builtins.open')
     def test_upload_queued(self, mock_open):
         api = self.get_api()
@@ -279,6 +374,15 @@ class TestClientUnit(unittest.TestCase):
                               api.upload_file, 'path/to/foo.gpx')
             mock_get.assert_not_called()
 
+    def test_index_by(self):
+        objs = [{'id': '1', 'title': 'foo'},
+                {'id': '2', 'title': 'bar'}]
+        self.assertEqual({'1': objs[0], '2': objs[1]},
+                         apiclient.index_by(objs, 'id'))
+        self.assertEqual({'foo': objs[0], 'bar': objs[1]},
+                         apiclient.index_by(objs, 'title'))
+        self.assertEqual({}, apiclient.index_by([], 'id'))
+
     def test_gurl(self):
         self.assertEqual('https://www.gaiagps.com/a/b/',
                          apiclient.gurl('a', 'b'))
@@ -307,6 +411,126 @@ class TestClientUnit(unittest.TestCase):
             apiclient.gurl('api', 'objects', 'waypoint'),
             params=expected_params)
 
+    def test_list_objects_cached(self):
+        with mock.patch.object(apiclient, 'orjson', new=None):
+            self._test_list_objects_cached()
+
+    def test_list_objects_cached_orjson(self):
+        # Stand-in with the same interface, in case orjson is not installed
+        fake_orjson = mock.MagicMock()
+        fake_orjson.loads.side_effect = lambda b: json.loads(b.decode())
+        fake_orjson.dumps.side_effect = lambda o: json.dumps(o).encode()
+        with mock.patch.object(apiclient, 'orjson', new=fake_orjson):
+            self._test_list_objects_cached()
+        fake_orjson.dumps.assert_called_with([{'id': '1'}])
+        fake_orjson.loads.assert_called_once_with(b'[{"id": "1"}]')
+
+    def _test_list_objects_cached(self):
+        api = self.get_api()
+        self.requests.get.return_value.json.return_value = [{'id': '1'}]
+        with tempfile.TemporaryDirectory() as cache_dir:
+            with mock.patch.object(apiclient, 'CACHE_DIR', new=cache_dir):
+                # Nothing cached yet, so we fetch and store it
+                self.assertEqual([{'id': '1'}],
+                                 api.list_objects('folder', max_age=60))
+                self.assertEqual(1, self.requests.get.call_count)
+
+                # Cached copy is used
+                self.assertEqual([{'id': '1'}],
+                                 api.list_objects('folder', max_age=60))
+                self.assertEqual(1, self.requests.get.call_count)
+
+                # Too old, or not asked to use the cache
+                api.list_objects('folder', max_age=0)
+                self.assertEqual(2, self.requests.get.call_count)
+                api.list_objects('folder')
+                self.assertEqual(3, self.requests.get.call_count)
+
+                # Different list, different cache
+                api.list_objects('folder', archived=False, max_age=60)
+                self.assertEqual(4, self.requests.get.call_count)
+
+    def test_list_objects_cache_private(self):
+        api = self.get_api()
+        self.requests.get.return_value.json.return_value = [{'id': '1'}]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache_dir = os.path.join(tmpdir, 'cache')
+            with mock.patch.object(apiclient, 'CACHE_DIR', new=cache_dir):
+                api.list_objects('folder', max_age=60)
+                cache_file = api._cache_file('folder', True)
+            self.assertEqual(0o700, os.stat(cache_dir).st_mode & 0o777)
+            self.assertEqual(0o600, os.stat(cache_file).st_mode & 0o777)
+
+    def test_list_objects_cache_pruned(self):
+        api = self.get_api()
+        self.requests.get.return_value.json.return_value = [{'id': '1'}]
+        with tempfile.TemporaryDirectory() as cache_dir:
+            stale = os.path.join(cache_dir, 'folder-123456789abc.json')
+            recent = os.path.join(cache_dir, 'folder-cba987654321.json')
+            other = os.path.join(cache_dir, 'README')
+            for fn in (stale, recent, other):
+                with open(fn, 'w') as f:
+                    f.write('[]')
+            os.utime(stale, (0, 0))
+            os.utime(other, (0, 0))
+            with mock.patch.object(apiclient, 'CACHE_DIR', new=cache_dir):
+                api.list_objects('folder', max_age=60)
+            self.assertFalse(os.path.exists(stale))
+            self.assertTrue(os.path.exists(recent))
+            self.assertTrue(os.path.exists(other))
+
+    def test_list_objects_cache_dropped_on_change(self):
+        api = self.get_api()
+        self.requests.get.return_value.json.return_value = [{'id': '1'}]
+        self.requests.put.return_value.status_code = 200
+        self.requests.post.return_value.json.return_value = {'id': '2'}
+        self.requests.post.return_value.content = b''
+        self.requests.post.return_value.url = apiclient.gurl('folder', '3')
+        changes = [
+            lambda: api.create_object('waypoint', {}),
+            lambda: api.put_object('folder', {'id': '1'}),
+            lambda: api.delete_object('track', '1'),
+            lambda: api.upload_file('foo.gpx', io.BytesIO(b'')),
+            lambda: api.set_objects_archive('waypoint', ['1']),
+        ]
+        with tempfile.TemporaryDirectory() as cache_dir:
+            with mock.patch.object(apiclient, 'CACHE_DIR', new=cache_dir):
+                for change in changes:
+                    with self.subTest(change=change):
+                        api.list_objects('folder', max_age=60)
+                        api.list_objects('waypoint', archived=False,
+                                         max_age=60)
+                        self.assertEqual(2, len(os.listdir(cache_dir)))
+                        change()
+                        self.assertEqual([], os.listdir(cache_dir))
+
+    def test_list_objects_cache_per_session(self):
+        api = self.get_api()
+        api.username = None
+
+        def cookie(value):
+            c = mock.MagicMock()
+            c.name = 'sessionid'
+            c.value = value
+            return c
+
+        api.s.cookies = [cookie('a')]
+        file_a = api._cache_file('folder', True)
+        api.s.cookies = [cookie('b')]
+        file_b = api._cache_file('folder', True)
+        self.assertNotEqual(file_a, file_b)
+
+        # No way to tell which account this is, so no cache
+        api.s.cookies = []
+        self.assertIsNone(api._cache_file('folder', True))
+        self.requests.get.return_value.json.return_value = [{'id': '1'}]
+        with tempfile.TemporaryDirectory() as cache_dir:
+            with mock.patch.object(apiclient, 'CACHE_DIR', new=cache_dir):
+                api.list_objects('folder', max_age=60)
+                api.list_objects('folder', max_age=60)
+                self.assertEqual([], os.listdir(cache_dir))
+        self.assertEqual(2, self.requests.get.call_count)
+
     def test_set_objects_archive(self):
         api = self.get_api()
         self.requests.put.return_value.status_code = 200
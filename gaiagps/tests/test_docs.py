@@ -1,3 +1,4 @@
+import contextlib
 import mock
 import os
 import shlex
@@ -6,6 +7,12 @@ import unittest
 from gaiagps import shell
 
 
+# Keep the tests away from the real cookie file in $HOME
+@contextlib.contextmanager
+def fake_cookiejar():
+    yield None
+
+
 class TestDocSnippetsUnit(unittest.TestCase):
     def _get_invocations(self, filename):
         key = '  $ gaiagps '
@@ -24,15 +31,20 @@ class TestDocSnippetsUnit(unittest.TestCase):
             name)                                        # /doc/source/$name
 
     @mock.patch('gaiagps.apiclient.GaiaClient')
+    @mock.patch('gaiagps.shell.cookiejar', new=fake_cookiejar)
     @mock.patch('gaiagps.shell.command.Command.dispatch')
+    @mock.patch('gaiagps.shell.daemon.listen')
+    @mock.patch('gaiagps.shell.daemon.daemonize')
     @mock.patch('sys.stdin.fileno')
-    def _test_invocation(self, location, command, mock_fileno, mock_dispatch,
+    def _test_invocation(self, location, command, mock_fileno,
+                         mock_daemonize, mock_listen, mock_dispatch,
                          mock_client):
         # For --user, we will check for is-terminal on stdin
         mock_fileno.return_value = -1
 
         # Return an impossible sentinel from any command
         mock_dispatch.return_value = 123456
+        mock_daemonize.return_value = 123456
 
         # Assert we ran the actual command and didn't fail in the parser
         self.assertEqual(123456, shell.main(shlex.split(command)),
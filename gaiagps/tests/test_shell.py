@@ -1,17 +1,26 @@
+import ast
 import contextlib
 import copy
 import datetime
+import functools
+import http.client
+import http.cookiejar
 import io
+import logging
 import mock
 import os
-import pprint
+import re
 import shlex
+import sys
 import tempfile
+import threading
 import time
 import unittest
 
 from gaiagps import apiclient
 from gaiagps import shell
+from gaiagps.shell import command
+from gaiagps.shell import daemon
 from gaiagps.tests import test_apiclient
 from gaiagps.tests import test_util
 from gaiagps import util
@@ -19,6 +28,10 @@ from gaiagps import util
 
 client = apiclient.GaiaClient
 _test_name = test_apiclient._test_name
+_WAYPOINT_URL = apiclient.gurl('api', 'objects', 'waypoint')
+
+# Show what each command printed, for debugging failing tests
+_DEBUG = bool(os.environ.get('GAIAGPSCLIENT_TEST_DEBUG'))
 
 
 class FakeOutput(io.StringIO):
@@ -76,7 +89,50 @@ class FakeClient(object):
     def __init__(self, *a, **k):
         pass
 
-    def list_objects(self, objtype, archived=True):
+    # Derived data, rebuilt only if a test replaces one of the lists above
+    _folder_list_cache = (None, None)
+    _index_cache = {}
+
+    def _folder_list(self):
+        sources = (self.FOLDERS, self.WAYPOINTS, self.TRACKS)
+        cached_sources, folders = FakeClient._folder_list_cache
+        if cached_sources is not None and all(
+                a is b for a, b in zip(cached_sources, sources)):
+            return folders
+
+        def ids_by_folder(objs):
+            by_folder = {}
+            for obj in objs:
+                by_folder.setdefault(obj['folder'], []).append(obj['id'])
+            return by_folder
+
+        waypoints = ids_by_folder(self.WAYPOINTS)
+        tracks = ids_by_folder(self.TRACKS)
+        children = ids_by_folder(self.FOLDERS)
+        folders = [dict(f,
+                        parent=f['folder'] or None,
+                        properties={'time_created': '2019-01-01T02:03:04Z'},
+                        maps=[],
+                        waypoints=waypoints.get(f['id'], []),
+                        tracks=tracks.get(f['id'], []),
+                        children=children.get(f['id'], []))
+                   for f in self.FOLDERS]
+        FakeClient._folder_list_cache = (sources, folders)
+        return folders
+
+    def _find(self, lst, key, value):
+        # Index by (key, value), keeping duplicates so that find() still
+        # complains about them
+        cached_lst, index = FakeClient._index_cache.get(id(lst), (None, None))
+        if cached_lst is not lst:
+            index = {}
+            for obj in lst:
+                for k in ('id', 'title'):
+                    index.setdefault((k, obj[k]), []).append(obj)
+            FakeClient._index_cache[id(lst)] = (lst, index)
+        return apiclient.find(index.get((key, value), []), key, value)
+
+    def list_objects(self, objtype, archived=True, max_age=None):
         def add_props(l):
             return [dict(d,
                          properties=d.get('properties',
@@ -93,20 +149,15 @@ class FakeClient(object):
         elif objtype == 'photo':
             return self.PHOTOS
         elif objtype == 'folder':
-            r = []
-            for f in self.FOLDERS:
-                r.append(dict(f,
-                              parent=f['folder'] or None,
-                              properties={'time_created':
-                                          '2019-01-01T02:03:04Z'},
-                              maps=[],
-                              waypoints=[w['id'] for w in self.WAYPOINTS
-                                         if w['folder'] == f['id']],
-                              tracks=[t['id'] for t in self.TRACKS
-                                      if t['folder'] == f['id']],
-                              children=[s['id'] for s in self.FOLDERS
-                                        if s['folder'] == f['id']]))
-            return r
+            # Only the lists and properties are nested, so copy just
+            # those rather than deepcopy() everything
+            return [dict(f,
+                         properties=dict(f['properties']),
+                         maps=[],
+                         waypoints=list(f['waypoints']),
+                         tracks=list(f['tracks']),
+                         children=list(f['children']))
+                    for f in self._folder_list()]
         else:
             raise Exception('Invalid type %s' % objtype)
 
@@ -131,7 +182,7 @@ class FakeClient(object):
             value = id_
 
         lst = getattr(self, objtype.upper() + 'S')
-        obj = dict(apiclient.find(lst, key, value))
+        obj = dict(self._find(lst, key, value))
 
         if fmt is not None:
             return 'object %s format %s' % (obj['id'], fmt)
@@ -157,9 +208,18 @@ class FakeClient(object):
     def add_object_to_folder(self, folderid, objtype, objid):
         raise NotImplementedError('Mock me')
 
+    def add_objects_to_folder(self, folderid, objtype, objids):
+        raise NotImplementedError('Mock me')
+
     def remove_object_from_folder(self, folderid, objtype, objid):
         raise NotImplementedError('Mock me')
 
+    def move_folder_contents(self, src_id, dst_id):
+        raise NotImplementedError('Mock me')
+
+    def remove_objects_from_folder(self, folderid, objtype, objids):
+        raise NotImplementedError('Mock me')
+
     def delete_object(self, objtype, id_):
         raise NotImplementedError('Mock me')
 
@@ -169,7 +229,7 @@ class FakeClient(object):
     def create_object(self, objtype, objdata):
         raise NotImplementedError('Mock me')
 
-    def upload_file(self, filename):
+    def upload_file(self, filename, fileobj=None):
         raise NotImplementedError('Mock me')
 
     def set_objects_archive(self, objtype, ids, archive):
@@ -236,24 +296,138 @@ def fake_is_id(name_or_id):
     return len(name_or_id) == 3 and name_or_id.isdigit()
 
 
+@functools.lru_cache(maxsize=256)
+def _split(cmdline):
+    # Many tests run the same command lines, and most do not need shlex
+    if '"' in cmdline or "'" in cmdline:
+        return tuple(shlex.split(cmdline))
+    return tuple(cmdline.split())
+
+
+_MISSING = object()
+
+
+@contextlib.contextmanager
+def _swap(cls, name, value=None):
+    """Temporarily replace an attribute of cls.
+
+    This does the same as mock.patch.object() for the simple case, but
+    with a lot less overhead. If cls does not have the attribute, it is
+    removed again afterwards, which allows shadowing a builtin in a
+    module.
+    """
+    if value is None:
+        value = mock.MagicMock()
+    old = cls.__dict__.get(name, _MISSING)
+    setattr(cls, name, value)
+    try:
+        yield value
+    finally:
+        if old is _MISSING:
+            delattr(cls, name)
+        else:
+            setattr(cls, name, old)
+
+
+# FakeClient keeps no state of its own (its mocks live on the class), so
+# every command in a test run can share one instance
+_FAKE_CLIENT = FakeClient()
+
+
+def fake_client(*args, **kwargs):
+    # Still run __init__ so that tests can patch it to check the
+    # arguments or make it fail
+    _FAKE_CLIENT.__init__(*args, **kwargs)
+    return _FAKE_CLIENT
+
+
 @mock.patch('gaiagps.shell.cookiejar', new=fake_cookiejar)
-@mock.patch.object(apiclient, 'GaiaClient', new=FakeClient)
+@mock.patch.object(apiclient, 'GaiaClient', new=fake_client)
 class TestShellUnit(unittest.TestCase):
+    # FakeClient methods that every test gets a fresh mock of, as
+    # self.<attribute>
+    _MOCKED_METHODS = {
+        'add_object_to_folder': 'mock_add_one',
+        'add_objects_to_folder': 'mock_add',
+        'create_object': 'mock_create',
+        'delete_object': 'mock_delete',
+        'move_folder_contents': 'mock_move',
+        'put_object': 'mock_put',
+        'remove_object_from_folder': 'mock_remove_one',
+        'remove_objects_from_folder': 'mock_remove',
+        'set_objects_archive': 'mock_archive',
+        'test_auth': 'mock_test',
+        'upload_file': 'mock_upload',
+    }
+
+    def setUp(self):
+        super().setUp()
+        # Drop anything a previous test left on the shared client
+        _FAKE_CLIENT.__dict__.clear()
+        for method, attr in self._MOCKED_METHODS.items():
+            setattr(self, attr, self._swap(FakeClient, method))
+
+    def _swap(self, obj, name, value=None):
+        """Replace obj.name (with a new mock by default) for this test."""
+        swapper = _swap(obj, name, value)
+        value = swapper.__enter__()
+        self.addCleanup(swapper.__exit__, None, None, None)
+        return value
+
+    def _setenv(self, name, value):
+        """Set an environment variable for this test."""
+        old = os.environ.get(name)
+        os.environ[name] = value
+        if old is None:
+            self.addCleanup(os.environ.pop, name, None)
+        else:
+            self.addCleanup(os.environ.__setitem__, name, old)
+
     def _run(self, cmdline, expect_fail=False):
         out = FakeOutput()
-        with mock.patch.multiple('sys', stdout=out, stderr=out, stdin=out):
-            rc = shell.main(shlex.split(cmdline))
-        print(out.getvalue())
+        saved = sys.stdout, sys.stderr, sys.stdin
+        sys.stdout = sys.stderr = sys.stdin = out
+        try:
+            rc = shell.main(list(_split(cmdline)))
+        finally:
+            sys.stdout, sys.stderr, sys.stdin = saved
+        if _DEBUG:
+            print(out.getvalue())
         if not expect_fail:
             self.assertEqual(0, rc)
         else:
             self.assertNotEqual(0, rc)
         return out.getvalue()
 
+    def _assert_tokens(self, out, present=(), absent=()):
+        """Check for whole words in out, splitting it only once."""
+        tokens = set(re.findall(r'\w+', out))
+        for token in present:
+            self.assertIn(token, tokens, out)
+        for token in absent:
+            self.assertNotIn(token, tokens, out)
+
+    def _parse(self, cmdline):
+        """Check that cmdline is rejected by the parser alone."""
+        out = FakeOutput()
+        with contextlib.redirect_stderr(out):
+            with self.assertRaises(SystemExit) as cm:
+                shell.build_parser().parse_args(shlex.split(cmdline))
+        self.assertNotEqual(0, cm.exception.code)
+        return out.getvalue()
+
     def test_first_run(self):
         out = self._run('', expect_fail=True)
         self.assertIn('usage:', out)
 
+    @mock.patch('gaiagps.shell.cookiejar')
+    def test_usage_skips_login(self, mock_cookiejar):
+        out = self._run('', expect_fail=True)
+        self.assertIn('usage:', out)
+        out = self._run('waypoint')
+        self.assertIn('usage:', out)
+        mock_cookiejar.assert_not_called()
+
     def test_waypoint_list_icons(self):
         out = self._run('waypoint list-icons')
         self.assertIn('chemist (chemist-24.png)', out)
@@ -265,12 +439,59 @@ class TestShellUnit(unittest.TestCase):
 
     def test_list_wpt(self):
         out = self._run('waypoint list')
-        self.assertIn('wpt1', out)
-        self.assertIn('wpt2', out)
-        self.assertIn('wpt3', out)
+        self._assert_tokens(out,
+                            ['wpt1', 'wpt2', 'wpt3', 'folder1', 'subfolder'],
+                            ['folder2'])
+
+    def test_list_wpt_lazy_subparsers(self):
+        # The waypoint add parser should not have been built
+        with mock.patch('gaiagps.shell.options.folder_ops') as mock_ops:
+            self._run('waypoint list')
+        progs = [c[0][0].prog for c in mock_ops.call_args_list]
+        self.assertNotIn('waypoint add', ' '.join(progs))
+        self._run('waypoint add -h')
+
+    def test_list_wpt_lazy_commands(self):
+        with mock.patch('gaiagps.shell.track.Track.opts') as mock_opts:
+            self._run('waypoint list')
+            mock_opts.assert_not_called()
+            self._run('track list', expect_fail=True)
+            self.assertTrue(mock_opts.called)
+
+    @mock.patch.object(command.Command, '_max_folder_lookups', new=1)
+    def test_list_wpt_many_folders(self):
+        # Exceed the individual lookup limit and fall back to listing
+        # all the folders
+        out = self._run('waypoint list')
         self.assertIn('folder1', out)
         self.assertIn('subfolder', out)
-        self.assertNotIn('folder2', out)
+
+    def test_list_wpt_folder_lookup_limit(self):
+        waypoints = FakeClient.WAYPOINTS + [
+            {'id': '004', 'folder': '102', 'title': 'wpt4'},
+            {'id': '005', 'folder': '104', 'title': 'wpt5'},
+        ]
+        get = mock.patch.object(FakeClient, 'get_object', autospec=True,
+                                side_effect=FakeClient.get_object)
+        lst = mock.patch.object(FakeClient, 'list_objects', autospec=True,
+                                side_effect=FakeClient.list_objects)
+        with mock.patch.object(FakeClient, 'WAYPOINTS', new=waypoints), \
+                get as mock_get, lst as mock_list:
+            out = self._run('waypoint list')
+        for name in ('folder1', 'folder2', 'subfolder', 'emptyfolder'):
+            self.assertIn(name, out)
+        # Four folders are referenced, so after two individual lookups
+        # the rest come from a single listing
+        self.assertEqual(2, len([c for c in mock_get.call_args_list
+                                 if c[0][1] == 'folder']))
+        self.assertEqual(1, len([c for c in mock_list.call_args_list
+                                 if c[0][1] == 'folder']))
+
+    def test_list_wpt_no_match_skips_folders(self):
+        with mock.patch.object(FakeClient, 'get_object') as mock_get:
+            out = self._run('waypoint list --match nothing')
+        self.assertNotIn('wpt1', out)
+        mock_get.assert_not_called()
 
     @mock.patch('gaiagps.util.is_id', new=lambda i: True)
     def test_list_formatted(self):
@@ -284,11 +505,9 @@ class TestShellUnit(unittest.TestCase):
 
     def test_list_trk(self):
         out = self._run('track list')
-        self.assertIn('trk1', out)
-        self.assertIn('trk2', out)
-        self.assertIn('folder2', out)
-        self.assertNotIn('folder1', out)
-        self.assertNotIn('subfolder', out)
+        self._assert_tokens(out,
+                            ['trk1', 'trk2', 'folder2'],
+                            ['folder1', 'subfolder'])
 
     def test_list_match(self):
         out = self._run('waypoint list --match w.*2')
@@ -297,24 +516,22 @@ class TestShellUnit(unittest.TestCase):
 
     def test_list_match_date(self):
         out = self._run('waypoint list --match-date 2019-03-14')
-        self.assertNotIn('wpt1', out)
-        self.assertNotIn('wpt2', out)
-        self.assertNotIn('wpt3', out)
+        self._assert_tokens(out, absent=['wpt1', 'wpt2', 'wpt3'])
 
         out = self._run('waypoint list --match-date 2015-10-21')
-        self.assertNotIn('wpt1', out)
-        self.assertNotIn('wpt2', out)
-        self.assertIn('wpt3', out)
+        self._assert_tokens(out, ['wpt3'], ['wpt1', 'wpt2'])
 
         out = self._run('waypoint list --match-date 2015-10-21:2015-10-22')
         self.assertNotIn('wpt1', out)
         self.assertNotIn('wpt2', out)
         self.assertIn('wpt3', out)
 
-        out = self._run('waypoint list --match-date foo',
-                        expect_fail=True)
-        out = self._run('waypoint list --match-date 2015-10-21:foo',
-                        expect_fail=True)
+        out = self._parse('waypoint list --match-date foo')
+        out = self._parse('waypoint list --match-date 2015-10-21:foo')
+        # int() would take these, but strptime() does not
+        for bad in ('+2015-10-21', '2015-1_0-21', "' 2015-10-21'"):
+            with self.subTest(date=bad):
+                self._parse('waypoint list --match-date %s' % bad)
 
     @mock.patch.object(FakeClient, 'list_objects')
     def test_list_archived_include_logic(self, mock_list):
@@ -330,22 +547,18 @@ class TestShellUnit(unittest.TestCase):
         mock_list.assert_called_once_with('waypoint', archived=True)
 
         mock_list.reset_mock()
-        self._run('waypoint list --archived=foo',
-                  expect_fail=True)
+        self._parse('waypoint list --archived=foo')
         mock_list.assert_not_called()
 
     def test_list_archived(self):
         out = self._run('waypoint list')
-        self.assertIn('wpt1', out)
-        self.assertIn('wpt2', out)
+        self._assert_tokens(out, ['wpt1', 'wpt2'])
 
         out = self._run('waypoint list --archived=y')
-        self.assertNotIn('wpt1', out)
-        self.assertIn('wpt2', out)
+        self._assert_tokens(out, ['wpt2'], ['wpt1'])
 
         out = self._run('waypoint list --archived=n')
-        self.assertIn('wpt1', out)
-        self.assertNotIn('wpt2', out)
+        self._assert_tokens(out, ['wpt1'], ['wpt2'])
 
     def test_list_in_folder(self):
         # List a folder with contents
@@ -363,161 +576,171 @@ class TestShellUnit(unittest.TestCase):
         self.assertNotIn('wpt1', out)
         self.assertNotIn('wpt2', out)
 
-    @mock.patch.object(FakeClient, 'add_object_to_folder')
-    def test_move(self, mock_add, verbose=False, dry=False):
+    def test_move(self):
+        for verbose, dry in ((False, False), (True, False), (True, True)):
+            with self.subTest(verbose=verbose, dry=dry):
+                self.mock_add.reset_mock()
+                self._test_move(verbose, dry)
+
+    def _test_move(self, verbose, dry):
         out = self._run('%s waypoint move wpt1 wpt2 folder2 %s' % (
             verbose and '--verbose' or '',
             dry and '--dry-run' or ''))
         if dry:
-            mock_add.assert_not_called()
+            self.mock_add.assert_not_called()
         else:
-            mock_add.assert_has_calls([mock.call('102', 'waypoint', '001'),
-                                       mock.call('102', 'waypoint', '002')])
+            self.mock_add.assert_called_once_with('102', 'waypoint',
+                                                  ['001', '002'])
         if verbose:
-            self.assertIn('wpt1', out)
-            self.assertIn('wpt2', out)
-            self.assertIn('folder2', out)
-            self.assertNotIn('wpt3', out)
-            self.assertNotIn('folder1', out)
-            self.assertNotIn('subfolder', out)
+            self._assert_tokens(out,
+                                ['wpt1', 'wpt2', 'folder2'],
+                                ['wpt3', 'folder1', 'subfolder'])
         elif dry:
             self.assertIn('Dry run', out)
         else:
             self.assertEqual('', out)
 
-    def test_move_verbose(self):
-        self.test_move(verbose=True)
-
-    def test_move_dry_run(self):
-        self.test_move(verbose=True, dry=True)
-
-    @mock.patch.object(FakeClient, 'add_object_to_folder')
-    def test_move_match(self, mock_add):
+    def test_move_match(self):
         self._run('waypoint move --match w.*2 folder2')
-        mock_add.assert_has_calls([mock.call('102', 'waypoint', '002')])
+        self.mock_add.assert_called_once_with('102', 'waypoint', ['002'])
 
-    @mock.patch.object(FakeClient, 'add_object_to_folder')
-    def test_move_match_date(self, mock_add):
+    def test_move_match_date(self):
         self._run('waypoint move --match-date 2015-10-21 folder2')
-        mock_add.assert_called_once_with('102', 'waypoint', '003')
+        self.mock_add.assert_called_once_with('102', 'waypoint', ['003'])
 
-    @mock.patch.object(FakeClient, 'add_object_to_folder')
-    def test_move_match_none(self, mock_add):
+    def test_move_match_none(self):
         out = self._run('waypoint move --match-date 2019-03-14 folder2',
                         expect_fail=True)
         self.assertIn('', out)
-        mock_add.assert_not_called()
+        self.mock_add.assert_not_called()
 
-    @mock.patch.object(FakeClient, 'add_object_to_folder')
-    def test_move_match_ambiguous(self, mock_add):
+    def test_move_match_ambiguous(self):
         out = self._run('--verbose waypoint move folder2',
                         expect_fail=True)
         self.assertIn('No items', out)
-        mock_add.assert_not_called()
+        self.mock_add.assert_not_called()
 
-    @mock.patch.object(FakeClient, 'add_object_to_folder')
-    def test_move_to_nonexistent_folder(self, mock_add):
+    def test_move_to_nonexistent_folder(self):
         out = self._run('waypoint move wpt1 wpt2 foobar',
                         expect_fail=True)
         self.assertIn('foobar not found', out)
-        mock_add.assert_not_called()
+        self.mock_add.assert_not_called()
 
-    @mock.patch.object(FakeClient, 'remove_object_from_folder')
-    def test_move_to_root(self, mock_remove):
+    def test_move_to_root(self):
         out = self._run('waypoint move wpt1 wpt2 /')
-        mock_remove.assert_has_calls([mock.call('101', 'waypoint', '002')])
+        self.mock_remove.assert_called_once_with('101', 'waypoint', ['002'])
         self.assertIn('\'wpt1\' is already at root', out)
 
-    @mock.patch.object(FakeClient, 'add_object_to_folder')
-    def test_move_in_folder_all(self, mock_add):
+    def test_move_to_root_multiple_folders(self):
+        self._run('waypoint move --match wpt /')
+        self.mock_remove.assert_has_calls(
+            [mock.call('101', 'waypoint', ['002']),
+             mock.call('103', 'waypoint', ['003'])],
+            any_order=True)
+        self.assertEqual(2, self.mock_remove.call_count)
+
+    def test_move_in_folder_all(self):
         self._run('--verbose waypoint move --in-folder folder1 folder2')
-        mock_add.assert_called_once_with('102', 'waypoint', '002')
+        self.mock_add.assert_called_once_with('102', 'waypoint', ['002'])
+
+    def test_remove(self):
+        for dry in (False, True):
+            with self.subTest(dry=dry):
+                self.mock_delete.reset_mock()
+                self._test_remove(dry)
 
-    @mock.patch.object(FakeClient, 'delete_object')
-    def test_remove(self, mock_delete, dry=False):
+    def _test_remove(self, dry):
         out = self._run('waypoint remove wpt1 wpt2 %s' % (
             dry and '--dry-run' or ''))
         if dry:
             self.assertIn('Dry run', out)
-            mock_delete.assert_not_called()
+            self.mock_delete.assert_not_called()
         else:
             self.assertEqual('', out)
-            mock_delete.assert_has_calls([mock.call('waypoint', '001'),
-                                          mock.call('waypoint', '002')])
+            self.mock_delete.assert_has_calls([mock.call('waypoint', '001'),
+                                               mock.call('waypoint', '002')])
 
-    def test_remove_dry_run(self):
-        self.test_remove(dry=True)
-
-    @mock.patch.object(FakeClient, 'delete_object')
-    def test_remove_match_verbose(self, mock_delete):
+    def test_remove_match_verbose(self):
         out = self._run('--verbose waypoint remove --match w.*2')
         self.assertIn('Removing waypoint \'wpt2\'', out)
-        mock_delete.assert_has_calls([mock.call('waypoint', '002')])
+        self.mock_delete.assert_has_calls([mock.call('waypoint', '002')])
+
+    def test_remove_match_multiple(self):
+        # Matches come pattern by pattern, in the order given
+        self._run('waypoint remove --match wpt3 w.*1')
+        self.assertEqual([mock.call('waypoint', '003'),
+                          mock.call('waypoint', '001')],
+                         self.mock_delete.call_args_list)
 
-    @mock.patch.object(FakeClient, 'delete_object')
-    def test_remove_missing(self, mock_delete):
+    def test_remove_missing(self):
         out = self._run('--verbose waypoint remove wpt7',
                         expect_fail=True)
         self.assertIn('not found', out)
-        mock_delete.assert_not_called()
+        self.mock_delete.assert_not_called()
 
-    @mock.patch.object(FakeClient, 'delete_object')
-    def test_remove_in_folder_all(self, mock_delete):
+    def test_remove_in_folder_all(self):
         out = self._run('--verbose waypoint remove --in-folder folder1')
         self.assertIn('wpt2', out)
-        mock_delete.assert_called_once_with('waypoint', '002')
-
-    @mock.patch.object(FakeClient, 'delete_object')
-    def test_remove_in_folder_filter(self, mock_delete):
+        self.mock_delete.assert_called_once_with('waypoint', '002')
+
+    def test_remove_in_folder_lists_once(self):
+        with mock.patch.object(FakeClient, 'list_objects', autospec=True,
+                               side_effect=FakeClient.list_objects) as m:
+            self._run('waypoint remove --in-folder folder1')
+        waypoint_lists = [c for c in m.call_args_list
+                          if c[0][1] == 'waypoint']
+        self.assertEqual(1, len(waypoint_lists))
+        self.mock_delete.assert_called_once_with('waypoint', '002')
+
+    def test_remove_in_folder_filter(self):
         out = self._run('--verbose waypoint remove --in-folder folder1 wpt2')
         self.assertIn('wpt2', out)
-        mock_delete.assert_called_once_with('waypoint', '002')
+        self.mock_delete.assert_called_once_with('waypoint', '002')
 
         # If we limit to a folder and by name, make sure we take the
         # intersection and not the union
-        mock_delete.reset_mock()
+        self.mock_delete.reset_mock()
         out = self._run('--verbose waypoint remove --in-folder folder1 wpt1')
         self.assertEqual('', out)
-        mock_delete.assert_not_called()
+        self.mock_delete.assert_not_called()
 
-    @mock.patch.object(FakeClient, 'delete_object')
-    def test_remove_nothing(self, mock_delete):
+    def test_remove_nothing(self):
         self._run('waypoint remove')
-        mock_delete.assert_not_called()
+        self.mock_delete.assert_not_called()
 
-    @mock.patch.object(FakeClient, 'delete_object')
-    def test_remove_folder_empty(self, mock_delete):
+    def test_remove_folder_empty(self):
         out = self._run('--verbose folder remove emptyfolder')
         self.assertIn('Removing', out)
-        mock_delete.assert_called_once_with('folder', '104')
+        self.mock_delete.assert_called_once_with('folder', '104')
 
-    @mock.patch.object(FakeClient, 'delete_object')
-    def test_remove_folder_nonempty(self, mock_delete):
+    def test_remove_folder_nonempty(self):
         out = self._run('--verbose folder remove folder1')
         self.assertIn('skipping', out)
-        mock_delete.assert_not_called()
+        self.mock_delete.assert_not_called()
 
-    @mock.patch.object(FakeClient, 'delete_object')
-    def test_remove_folder_nonempty_force(self, mock_delete):
+    def test_remove_folder_nonempty_force(self):
         out = self._run('--verbose folder remove --force folder1')
         self.assertIn('Warning', out)
-        mock_delete.assert_called_once_with('folder', '101')
+        self.mock_delete.assert_called_once_with('folder', '101')
 
     @mock.patch('builtins.input')
-    @mock.patch('os.isatty', return_value=True)
-    @mock.patch.object(FakeClient, 'delete_object')
-    def test_remove_folder_nonempty_prompt(self, mock_delete, mock_tty,
-                                           mock_input):
+    def test_remove_folder_nonempty_prompt(self, mock_input):
+        self._swap(os, 'isatty', lambda fd: True)
         mock_input.return_value = ''
         self._run('--verbose folder remove folder1')
-        mock_delete.assert_not_called()
+        self.mock_delete.assert_not_called()
 
         mock_input.return_value = 'y'
         self._run('--verbose folder remove folder1')
-        mock_delete.assert_called_once_with('folder', '101')
+        self.mock_delete.assert_called_once_with('folder', '101')
+
+    def test_rename_waypoint(self):
+        for dry in (False, True):
+            with self.subTest(dry=dry):
+                self.mock_put.reset_mock()
+                self._test_rename_waypoint(dry)
 
-    @mock.patch.object(FakeClient, 'put_object')
-    def test_rename_waypoint(self, mock_put, dry=False):
+    def _test_rename_waypoint(self, dry):
         out = self._run(
             '--verbose waypoint rename wpt2 wpt7 %s' % (
                 dry and '--dry-run' or ''))
@@ -528,24 +751,19 @@ class TestShellUnit(unittest.TestCase):
                    'geometry': {'coordinates': [-122.0, 45.5, 123]},
                    'deleted': True}
         if dry:
-            mock_put.assert_not_called()
+            self.mock_put.assert_not_called()
         else:
-            mock_put.assert_called_once_with('waypoint', new_wpt)
+            self.mock_put.assert_called_once_with('waypoint', new_wpt)
 
-    def test_rename_dry_run(self):
-        self.test_rename_waypoint(dry=True)
-
-    @mock.patch.object(FakeClient, 'put_object')
-    def test_rename_track(self, mock_put):
+    def test_rename_track(self):
         out = self._run('--verbose track rename trk2 trk7')
         self.assertIn('Renaming', out)
         new_trk = {'id': '202', 'title': 'trk7'}
-        mock_put.assert_called_once_with('track', new_trk)
+        self.mock_put.assert_called_once_with('track', new_trk)
 
-    @mock.patch.object(FakeClient, 'put_object')
     @mock.patch('builtins.open')
     @mock.patch('yaml.dump')
-    def test_edit_track_dump(self, mock_dump, mock_open, mock_put):
+    def test_edit_track_dump(self, mock_dump, mock_open):
         out = self._run('track edit trk1')
         self.assertIn('Edit and then apply', out)
         mock_open.assert_called_once_with('tracks.yml', 'w')
@@ -553,13 +771,14 @@ class TestShellUnit(unittest.TestCase):
         preamble = fake_file.write.call_args_list[0][0][0]
         self.assertIn('YAML document', preamble)
         self.assertIn('yellow', preamble)
-        fake_file.write.assert_has_calls([mock.call(mock_dump.return_value)])
-        mock_put.assert_not_called()
+        mock_dump.assert_called_once_with(mock.ANY, fake_file,
+                                          Dumper=command.SafeDumper,
+                                          default_flow_style=False)
+        self.mock_put.assert_not_called()
 
-    @mock.patch.object(FakeClient, 'put_object')
     @mock.patch('builtins.open')
     @mock.patch('yaml.load')
-    def test_edit_track_load(self, mock_load, mock_open, mock_put):
+    def test_edit_track_load(self, mock_load, mock_open):
         mock_load.return_value = [{'id': '201',
                                    'features': [{
                                        'properties': {
@@ -572,19 +791,18 @@ class TestShellUnit(unittest.TestCase):
         self.assertEqual('', out)
         mock_open.assert_called_once_with('tracks.yml', 'r')
         fake_file = mock_open.return_value.__enter__.return_value
-        fake_file.read.assert_called_once_with()
-        mock_load.assert_called_once_with(fake_file.read.return_value)
+        mock_load.assert_called_once_with(fake_file,
+                                          Loader=command.SafeLoader)
         obj = FakeClient().get_object('track', 'trk1')
         expected = copy.deepcopy(obj['features'][0]['properties'])
         expected['title'] = 'newname'
         expected['color'] = '#F42410'
         expected['id'] = obj['id']
-        mock_put.assert_called_once_with('track', expected)
+        self.mock_put.assert_called_once_with('track', expected)
 
-    @mock.patch.object(FakeClient, 'put_object')
     @mock.patch('builtins.open')
     @mock.patch('yaml.load')
-    def test_edit_track_load_errors(self, mock_load, mock_open, mock_put):
+    def test_edit_track_load_errors(self, mock_load, mock_open):
         # User deleted revision
         mock_load.return_value = [{'id': '201',
                                    'features': [{
@@ -624,144 +842,124 @@ class TestShellUnit(unittest.TestCase):
                         expect_fail=True)
         self.assertIn('items but matched', out)
 
-    @mock.patch.object(FakeClient, 'put_object')
-    def test_rename_fail(self, mock_put):
-        mock_put.return_value = None
+    def test_rename_fail(self):
+        self.mock_put.return_value = None
         out = self._run('track rename trk2 trk7',
                         expect_fail=True)
         self.assertIn('Failed to rename', out)
 
-    @mock.patch.object(FakeClient, 'create_object')
-    def test_add_waypoint(self, mock_create):
+    def test_add_waypoint(self):
         out = self._run('waypoint add foo 1.5 2.6')
         self.assertEqual('', out)
-        mock_create.assert_called_once_with(
+        self.mock_create.assert_called_once_with(
             'waypoint',
             util.make_waypoint('foo', 1.5, 2.6, 0))
 
-    @mock.patch.object(FakeClient, 'create_object')
-    @mock.patch.object(FakeClient, 'add_object_to_folder')
-    def test_add_waypoint_dry_run(self, mock_add, mock_create):
-        out = self._run('waypoint add --dry-run test 1 2')
-        self.assertIn('Dry run', out)
-        mock_create.assert_not_called()
-        mock_add.assert_not_called()
-
-        out = self._run('waypoint add --dry-run --new-folder foo test 1 2')
-        self.assertIn('Dry run', out)
-        mock_create.assert_not_called()
-        mock_add.assert_not_called()
-
-        out = self._run('waypoint add --dry-run --existing-folder folder1 '
-                        'test 1 2')
-        self.assertIn('Dry run', out)
-        mock_create.assert_not_called()
-        mock_add.assert_not_called()
-
-    @mock.patch.object(FakeClient, 'create_object')
-    def test_add_waypoint_with_altitude(self, mock_create):
+    def _test_dry_run(self, cmdline_fmt, variants):
+        for extra in variants:
+            with self.subTest(extra=extra):
+                out = self._run(cmdline_fmt % extra)
+                self.assertIn('Dry run', out)
+                self.mock_create.assert_not_called()
+                self.mock_add_one.assert_not_called()
+
+    def test_add_waypoint_dry_run(self):
+        self._test_dry_run('waypoint add --dry-run %s test 1 2',
+                           ['', '--new-folder foo',
+                            '--existing-folder folder1'])
+
+    def test_add_waypoint_with_altitude(self):
         out = self._run('waypoint add foo 1.5 2.6 3')
         self.assertEqual('', out)
-        mock_create.assert_called_once_with(
+        self.mock_create.assert_called_once_with(
             'waypoint',
             util.make_waypoint('foo', 1.5, 2.6, 3))
 
-    @mock.patch.object(FakeClient, 'create_object')
-    def test_add_waypoint_with_extras(self, mock_create):
+    def test_add_waypoint_with_extras(self):
         out = self._run('waypoint add foo 1.5 2.6 3 '
                         '--icon "foo.png" --notes "these are notes"')
         self.assertEqual('', out)
-        mock_create.assert_called_once_with(
+        self.mock_create.assert_called_once_with(
             'waypoint',
             util.make_waypoint('foo', 1.5, 2.6,
                                alt=3,
                                notes='these are notes',
                                icon='foo.png'))
 
-    @mock.patch.object(FakeClient, 'create_object')
-    def test_add_waypoint_with_icon_by_alias(self, mock_create):
+    def test_add_waypoint_with_icon_by_alias(self):
         out = self._run('waypoint add foo 1.5 2.6 3 '
                         '--icon fuel')
         self.assertEqual('', out)
-        mock_create.assert_called_once_with(
+        self.mock_create.assert_called_once_with(
             'waypoint',
             util.make_waypoint('foo', 1.5, 2.6,
                                alt=3,
                                icon='fuel-24.png'))
 
-    @mock.patch.object(FakeClient, 'create_object')
-    def test_add_waypoint_bad_data(self, mock_create):
-        out = self._run('waypoint add foo a 2.6',
-                        expect_fail=True)
-        self.assertIn('Latitude', out)
-
-        out = self._run('waypoint add foo 1.5 a',
-                        expect_fail=True)
-        self.assertIn('Longitude', out)
-
-        out = self._run('waypoint add foo 1.5 2.6 a',
-                        expect_fail=True)
-        self.assertIn('Altitude', out)
-
-    @mock.patch.object(FakeClient, 'create_object')
-    def test_add_waypoint_failed(self, mock_create):
-        mock_create.return_value = None
+    def test_add_waypoint_bad_data(self):
+        cases = [('foo a 2.6', 'Latitude'),
+                 ('foo 1.5 a', 'Longitude'),
+                 ('foo 1.5 2.6 a', 'Altitude')]
+        for args, error in cases:
+            with self.subTest(args=args):
+                out = self._run('waypoint add %s' % args,
+                                expect_fail=True)
+                self.assertIn(error, out)
+
+    def test_add_waypoint_failed(self):
+        self.mock_create.return_value = None
         out = self._run('waypoint add foo 1.2 2.6',
                         expect_fail=True)
         self.assertIn('Failed to create waypoint', out)
 
-    @mock.patch.object(FakeClient, 'create_object')
-    @mock.patch.object(FakeClient, 'add_object_to_folder')
-    def test_add_waypoint_new_folder(self, mock_add, mock_create):
-        mock_create.side_effect = [
+    def test_add_waypoint_new_folder(self):
+        self.mock_create.side_effect = [
             {'id': '1'},
             {'id': '2', 'properties': {'name': 'folder'}}]
         out = self._run('waypoint add --new-folder bar foo 1.5 2.6')
         self.assertEqual('', out)
-        mock_create.assert_has_calls([
+        self.mock_create.assert_has_calls([
             mock.call('waypoint',
                       util.make_waypoint('foo', 1.5, 2.6, 0)),
             mock.call('folder',
                       util.make_folder('bar'))])
-        mock_add.assert_called_once_with('2', 'waypoint', '1')
+        self.mock_add_one.assert_called_once_with('2', 'waypoint', '1')
 
-    @mock.patch.object(FakeClient, 'create_object')
-    @mock.patch.object(FakeClient, 'add_object_to_folder')
-    def test_add_waypoint_existing_folder(self, mock_add, mock_create):
-        mock_create.side_effect = [
+    def test_add_waypoint_existing_folder(self):
+        self.mock_create.side_effect = [
             {'id': '1'},
             {'id': '2', 'properties': {'name': 'folder'}}]
         out = self._run(
             'waypoint add --existing-folder folder1 foo 1.5 2.6')
         self.assertEqual('', out)
-        mock_create.assert_has_calls([
+        self.mock_create.assert_has_calls([
             mock.call('waypoint',
                       util.make_waypoint('foo', 1.5, 2.6, 0))])
-        mock_add.assert_called_once_with('101', 'waypoint', '1')
+        self.mock_add_one.assert_called_once_with('101', 'waypoint', '1')
 
     def test_add_waypoint_existing_folder_not_found(self):
         out = self._run('waypoint add --existing-folder bar foo 1.5 2.6',
                         expect_fail=True)
         self.assertIn('not found', out)
 
-    @mock.patch.object(FakeClient, 'put_object')
     @mock.patch('builtins.open')
     @mock.patch('yaml.dump')
-    def test_edit_waypoint_dump(self, mock_dump, mock_open, mock_put):
+    def test_edit_waypoint_dump(self, mock_dump, mock_open):
         out = self._run('waypoint edit wpt3')
         self.assertIn('Edit and then apply', out)
         mock_open.assert_called_once_with('waypoints.yml', 'w')
         fake_file = mock_open.return_value.__enter__.return_value
-        fake_file.write.assert_has_calls([mock.call(mock_dump.return_value)])
+        mock_dump.assert_called_once_with(mock.ANY, fake_file,
+                                          Dumper=command.SafeDumper,
+                                          default_flow_style=False)
         preamble = fake_file.write.call_args_list[0][0][0]
         self.assertIn('YAML document', preamble)
         self.assertIn('chemist', preamble)
-        mock_put.assert_not_called()
+        self.mock_put.assert_not_called()
 
-    @mock.patch.object(FakeClient, 'put_object')
     @mock.patch('builtins.open')
     @mock.patch('yaml.load')
-    def test_edit_waypoint_load(self, mock_load, mock_open, mock_put):
+    def test_edit_waypoint_load(self, mock_load, mock_open):
         mock_load.return_value = [{'id': '003',
                                    'properties': {
                                        'icon': 'foo',
@@ -773,16 +971,15 @@ class TestShellUnit(unittest.TestCase):
         self.assertEqual('', out)
         mock_open.assert_called_once_with('waypoint.yml', 'r')
         fake_file = mock_open.return_value.__enter__.return_value
-        fake_file.read.assert_called_once_with()
-        mock_load.assert_called_once_with(fake_file.read.return_value)
+        mock_load.assert_called_once_with(fake_file,
+                                          Loader=command.SafeLoader)
         updated = copy.deepcopy(FakeClient().get_object('waypoint', 'wpt3'))
         updated['properties']['title'] = 'newname'
-        mock_put.assert_called_once_with('waypoint', updated)
+        self.mock_put.assert_called_once_with('waypoint', updated)
 
-    @mock.patch.object(FakeClient, 'put_object')
     @mock.patch('builtins.open')
     @mock.patch('yaml.load')
-    def test_edit_waypoint_load_errors(self, mock_load, mock_open, mock_put):
+    def test_edit_waypoint_load_errors(self, mock_load, mock_open):
         # Server rejected for whatever reason
         mock_load.return_value = [{'id': '003',
                                    'properties': {'revision': 6,
@@ -790,14 +987,14 @@ class TestShellUnit(unittest.TestCase):
                                                   'notes': '',
                                                   'public': False,
                                                   'title': 'val'}}]
-        mock_put.return_value = False
+        self.mock_put.return_value = False
         out = self._run('waypoint edit wpt3 -f waypoint.yml',
                         expect_fail=True)
         self.assertIn('server rejected', out)
 
         # YAML top-level is not a list
         mock_load.return_value = {'id': '003'}
-        mock_put.return_value = False
+        self.mock_put.return_value = False
         out = self._run('waypoint edit wpt3 -f waypoint.yml',
                         expect_fail=True)
         self.assertIn('format is incorrect', out)
@@ -872,6 +1069,43 @@ class TestShellUnit(unittest.TestCase):
                         expect_fail=True)
         self.assertIn('test failed', out)
 
+    @mock.patch('builtins.open')
+    @mock.patch('yaml.load')
+    @mock.patch('yaml.dump')
+    @mock.patch('subprocess.call')
+    @mock.patch('os.path.getmtime')
+    @mock.patch('gaiagps.util.get_editor')
+    def test_edit_waypoint_interactive_unchanged(self, mock_editor,
+                                                 mock_mtime, mock_call,
+                                                 mock_dump, mock_load,
+                                                 mock_open):
+        mock_mtime.side_effect = [123, 456]
+        mock_editor.return_value = '/usr/bin/editor'
+
+        def fake_load(f, Loader):
+            edited = copy.deepcopy(mock_dump.call_args[0][0])
+            edited[-1]['properties']['title'] = 'newname'
+            return edited
+
+        mock_load.side_effect = fake_load
+        self._run('waypoint edit wpt3 -i')
+        self.mock_put.assert_called_once_with('waypoint', mock.ANY)
+        self.assertEqual('newname',
+                         self.mock_put.call_args[0][1]['properties']['title'])
+
+        # Saved without changing anything
+        mock_mtime.side_effect = [123, 456]
+        mock_load.side_effect = lambda f, Loader: copy.deepcopy(
+            mock_dump.call_args[0][0])
+        self.mock_put.reset_mock()
+        with mock.patch.object(FakeClient, 'get_object',
+                               wraps=FakeClient().get_object) as mock_get:
+            out = self._run('waypoint edit wpt3 -i')
+        self.assertIn('No changes made', out)
+        self.mock_put.assert_not_called()
+        # Only fetched once, for the dump
+        mock_get.assert_called_once_with('waypoint', id_='003')
+
     @mock.patch('gaiagps.util.get_editor')
     def test_edit_waypoint_no_editor(self, mock_editor):
         mock_editor.return_value = None
@@ -916,32 +1150,30 @@ class TestShellUnit(unittest.TestCase):
         self.assertIn('No objects matched', out)
         mock_dump.assert_not_called()
 
-    @mock.patch.object(FakeClient, 'upload_file')
-    def test_upload(self, mock_upload):
+    def test_upload(self):
         self._run('upload foo.gpx')
-        mock_upload.assert_called_once_with('foo.gpx')
+        self.mock_upload.assert_called_once_with('foo.gpx')
 
-    @mock.patch.object(FakeClient, 'upload_file')
     @mock.patch('gaiagps.util.strip_gpx_extensions')
-    def test_upload_strip_gpx_extensions(self, mock_strip, mock_upload):
+    def test_upload_strip_gpx_extensions(self, mock_strip):
         self._run('upload --strip-gpx-extensions /path/to/foo.gpx')
-        mock_strip.assert_called_once_with('/path/to/foo.gpx',
-                                           '/path/to/clean-foo.gpx')
-        mock_upload.assert_called_once_with('/path/to/clean-foo.gpx')
+        mock_strip.assert_called_once_with('/path/to/foo.gpx', mock.ANY)
+        cleaned = mock_strip.call_args[0][1]
+        self.assertIsInstance(cleaned, io.BytesIO)
+        self.mock_upload.assert_called_once_with('/path/to/foo.gpx',
+                                                 fileobj=cleaned)
 
     @mock.patch.object(FakeClient, 'get_object')
-    @mock.patch.object(FakeClient, 'upload_file')
-    def test_upload_queued(self, mock_upload, mock_get):
-        mock_upload.return_value = None
+    def test_upload_queued(self, mock_get):
+        self.mock_upload.return_value = None
         out = self._run('upload --existing-folder foo foo.gpx')
         self.assertIn('upload has been queued', out)
         self.assertIn('Unable to move', out)
 
     @mock.patch('time.sleep')
     @mock.patch.object(FakeClient, 'get_object')
-    @mock.patch.object(FakeClient, 'upload_file')
-    def test_upload_queued_poll(self, mock_upload, mock_get, mock_sleep):
-        mock_upload.return_value = None
+    def test_upload_queued_poll(self, mock_get, mock_sleep):
+        self.mock_upload.return_value = None
         mock_get.side_effect = [apiclient.NotFound,
                                 apiclient.NotFound,
                                 {'id': 'foo',
@@ -957,21 +1189,19 @@ class TestShellUnit(unittest.TestCase):
         out = self._run('--verbose upload --poll foo.gpx')
         self.assertIn('queued at the server', out)
 
-    @mock.patch.object(FakeClient, 'upload_file')
     @mock.patch('gaiagps.util.get_track_colors_from_gpx')
-    @mock.patch.object(FakeClient, 'put_object')
-    def test_upload_colorize_tracks(self, mock_put, mock_colors, mock_upload):
-        mock_upload.return_value = {'id': '102',
-                                    'properties': {'name': 'folder2'}}
+    def test_upload_colorize_tracks(self, mock_colors):
+        self.mock_upload.return_value = {'id': '102',
+                                         'properties': {'name': 'folder2'}}
         mock_colors.return_value = {'trk1': 'Red',
                                     'trk2': 'Green'}
         self._run('--verbose upload --colorize-tracks foo.gpx')
         # Since we're reusing fake folder2 from the fixture, which has
         # only trk2 in it, we expect to only see trk2 updated since
         # upload calls colorize with the GPX upload folder
-        mock_put.assert_called_once_with('track',
-                                         {'id': '202',
-                                          'color': '#36C03B'})
+        self.mock_put.assert_called_once_with('track',
+                                              {'id': '202',
+                                               'color': '#36C03B'})
 
         # Try again without a gpx file and make sure we report it,
         # but do not fail
@@ -979,45 +1209,37 @@ class TestShellUnit(unittest.TestCase):
         out = self._run('--verbose upload --colorize-tracks foo.kml')
         self.assertIn('Failed to colorize', out)
 
-    @mock.patch.object(FakeClient, 'set_objects_archive')
-    def _test_archive_waypoint(self, cmd, mock_archive):
+    def test_archive_waypoint(self):
         args = [
             'wpt3',
             '--match w.*3',
             '--match-date 2015-10-21',
         ]
-        for arg in args:
-            mock_archive.reset_mock()
-            self._run('waypoint %s %s' % (cmd, arg))
-            mock_archive.assert_called_once_with('waypoint', ['003'],
-                                                 cmd == 'archive')
-
-    def test_archive_waypoint(self):
-        self._test_archive_waypoint('archive')
-
-    def test_unarchive_waypoint(self):
-        self._test_archive_waypoint('unarchive')
-
-    @mock.patch.object(FakeClient, 'set_objects_archive')
-    def test_archive_dry_run(self, mock_archive):
+        for cmd in ('archive', 'unarchive'):
+            for arg in args:
+                with self.subTest(cmd=cmd, arg=arg):
+                    self.mock_archive.reset_mock()
+                    self._run('waypoint %s %s' % (cmd, arg))
+                    self.mock_archive.assert_called_once_with(
+                        'waypoint', ['003'], cmd == 'archive')
+
+    def test_archive_dry_run(self):
         self._run('waypoint archive --dry-run wpt3')
-        mock_archive.assert_not_called()
+        self.mock_archive.assert_not_called()
 
-    @mock.patch.object(FakeClient, 'set_objects_archive')
-    def test_archive_fails(self, mock_archive):
+    def test_archive_fails(self):
         self._run('waypoint archive',
                   expect_fail=True)
-        mock_archive.assert_not_called()
+        self.mock_archive.assert_not_called()
 
         self._run('waypoint archive --match nothing',
                   expect_fail=True)
-        mock_archive.assert_not_called()
+        self.mock_archive.assert_not_called()
 
-    @mock.patch.object(FakeClient, 'set_objects_archive')
-    def test_archive_in_folder(self, mock_archive):
+    def test_archive_in_folder(self):
         self._run('waypoint archive --in-folder folder1')
-        mock_archive.assert_called_once_with('waypoint', ['002'],
-                                             True)
+        self.mock_archive.assert_called_once_with('waypoint', ['002'],
+                                                  True)
 
     @mock.patch('gaiagps.util.is_id', new=fake_is_id)
     def test_waypoint_coords(self):
@@ -1037,197 +1259,115 @@ class TestShellUnit(unittest.TestCase):
         self._run('waypoint coords',
                   expect_fail=True)
 
-    @mock.patch.object(FakeClient, 'create_object')
-    def test_add_folder(self, fake_create):
+    def test_add_folder(self):
         out = self._run('folder add foo')
         self.assertEqual('', out)
-        fake_create.assert_called_once_with('folder', util.make_folder('foo'))
-
-    @mock.patch.object(FakeClient, 'create_object')
-    @mock.patch.object(FakeClient, 'add_object_to_folder')
-    def test_add_folder_dry_run(self, fake_add, fake_create):
-        out = self._run('folder add --dry-run foo')
-        self.assertIn('Dry run', out)
-        fake_create.assert_not_called()
-        fake_add.assert_not_called()
-
-        out = self._run('folder add --dry-run --existing-folder folder1 '
-                        'foo')
-        self.assertIn('Dry run', out)
-        fake_create.assert_not_called()
-        fake_add.assert_not_called()
-
-    @mock.patch.object(FakeClient, 'create_object')
-    def test_add_folder_failed(self, mock_create):
-        mock_create.return_value = None
+        self.mock_create.assert_called_once_with('folder',
+                                                 util.make_folder('foo'))
+
+    def test_add_folder_dry_run(self):
+        self._test_dry_run('folder add --dry-run %s foo',
+                           ['', '--existing-folder folder1'])
+
+    def test_add_folder_failed(self):
+        self.mock_create.return_value = None
         out = self._run('folder add foo',
                         expect_fail=True)
         self.assertIn('Failed to add folder', out)
 
-    @mock.patch.object(FakeClient, 'create_object')
-    @mock.patch.object(FakeClient, 'add_object_to_folder')
-    def test_add_folder_to_existing(self, fake_add, fake_create):
-        fake_create.return_value = {'id': '105'}
+    def test_add_folder_to_existing(self):
+        self.mock_create.return_value = {'id': '105'}
         out = self._run('folder add --existing-folder folder1 foo')
         self.assertEqual('', out)
-        fake_create.assert_called_once_with('folder', util.make_folder('foo'))
-        fake_add.assert_called_once_with('101', 'folder', '105')
-
-    @mock.patch.object(FakeClient, 'create_object')
-    @mock.patch.object(FakeClient, 'add_object_to_folder')
-    def test_add_folder_to_existing_fail(self, fake_add, fake_create):
-        fake_create.return_value = {'id': '105'}
-        fake_add.return_value = None
+        self.mock_create.assert_called_once_with('folder',
+                                                 util.make_folder('foo'))
+        self.mock_add_one.assert_called_once_with('101', 'folder', '105')
+
+    def test_add_folder_to_existing_fail(self):
+        self.mock_create.return_value = {'id': '105'}
+        self.mock_add_one.return_value = None
         out = self._run('folder add --existing-folder folder1 foo',
                         expect_fail=True)
         self.assertIn('failed to add', out)
-        fake_create.assert_called_once_with('folder', util.make_folder('foo'))
+        self.mock_create.assert_called_once_with('folder',
+                                                 util.make_folder('foo'))
 
-    @mock.patch.object(FakeClient, 'put_object')
-    def test_rename_folder(self, mock_put):
+    def test_rename_folder(self):
         out = self._run('--verbose folder rename folder1 newfolder')
         self.assertIn('Renaming', out)
         new_fld = {'id': '101', 'title': 'newfolder'}
-        mock_put.assert_called_once_with('folder', new_fld)
+        self.mock_put.assert_called_once_with('folder', new_fld)
 
-    @mock.patch.object(FakeClient, 'upload_file')
-    @mock.patch.object(FakeClient, 'put_object')
-    @mock.patch.object(FakeClient, 'delete_object')
-    def test_upload_existing_folder(self, mock_delete, mock_put, mock_upload):
-        mock_upload.return_value = {'id': '105', 'properties': {
+    def test_upload_existing_folder(self):
+        self.mock_upload.return_value = {'id': '105', 'properties': {
             'name': 'foo.gpx'}}
 
-        folders_copy = copy.deepcopy(FakeClient.FOLDERS)
-        folders_copy.append({'id': '105',
-                             'title': 'foo.gpx',
-                             'folder': None,
-                             'properties': {}})
-
-        waypoints_copy = copy.deepcopy(FakeClient.WAYPOINTS)
-        waypoints_copy.append({'id': '010', 'folder': '105', 'title': 'wpt8'})
-        waypoints_copy.append({'id': '011', 'folder': '105', 'title': 'wpt9'})
-
-        tracks_copy = copy.deepcopy(FakeClient.TRACKS)
-        tracks_copy.append({'id': '210', 'folder': '105', 'title': 'trk8'})
-        tracks_copy.append({'id': '211', 'folder': '105', 'title': 'trk9'})
-
-        with mock.patch.multiple(FakeClient,
-                                 FOLDERS=folders_copy,
-                                 WAYPOINTS=waypoints_copy,
-                                 TRACKS=tracks_copy):
-            self._run('upload --existing-folder folder1 foo.gpx')
-
-        expected = copy.deepcopy(FakeClient.FOLDERS[0])
-        expected['parent'] = None
-        expected['children'] = ['103']
-        expected['maps'] = []
-        expected['waypoints'] = ['002', '010', '011']
-        expected['tracks'] = ['210', '211']
-        expected['properties'] = {'time_created': '2019-01-01T02:03:04Z'}
-        mock_put.assert_called_once_with('folder', expected)
-        mock_delete.assert_called_once_with('folder', '105')
-
-    @mock.patch.object(FakeClient, 'upload_file')
-    @mock.patch.object(FakeClient, 'put_object')
-    @mock.patch.object(FakeClient, 'delete_object')
-    @mock.patch.object(FakeClient, 'create_object')
-    def test_upload_new_folder(self, mock_create, mock_delete, mock_put,
-                               mock_upload):
-        mock_upload.return_value = {'id': '105', 'properties': {
+        self._run('upload --existing-folder folder1 foo.gpx')
+
+        self.mock_move.assert_called_once_with('105', '101')
+        self.mock_delete.assert_called_once_with('folder', '105')
+
+    def test_upload_new_folder(self):
+        self.mock_upload.return_value = {'id': '105', 'properties': {
             'name': 'foo.gpx'}}
+        self.mock_create.return_value = {'id': '106',
+                                         'title': 'newfolder',
+                                         'folder': None,
+                                         'properties': {'name': 'newfolder'}}
+
+        self._run('upload --new-folder newfolder foo.gpx')
 
-        folders_copy = copy.deepcopy(FakeClient.FOLDERS)
-        folders_copy.append({'id': '105',
-                             'title': 'foo.gpx',
-                             'folder': None,
-                             'properties': {}})
-        folders_copy.append({'id': '106',
-                             'title': 'newfolder',
-                             'folder': None,
-                             'properties': {'name': 'newfolder'}})
-
-        mock_create.return_value = folders_copy[-1]
-
-        waypoints_copy = copy.deepcopy(FakeClient.WAYPOINTS)
-        waypoints_copy.append({'id': '010', 'folder': '105', 'title': 'wpt8'})
-        waypoints_copy.append({'id': '011', 'folder': '105', 'title': 'wpt9'})
-
-        tracks_copy = copy.deepcopy(FakeClient.TRACKS)
-        tracks_copy.append({'id': '210', 'folder': '105', 'title': 'trk8'})
-        tracks_copy.append({'id': '211', 'folder': '105', 'title': 'trk9'})
-
-        with mock.patch.multiple(FakeClient,
-                                 FOLDERS=folders_copy,
-                                 WAYPOINTS=waypoints_copy,
-                                 TRACKS=tracks_copy):
-            self._run('upload --new-folder newfolder foo.gpx')
-
-        expected = copy.deepcopy(folders_copy[-1])
-        expected['parent'] = None
-        expected['children'] = []
-        expected['maps'] = []
-        expected['waypoints'] = ['010', '011']
-        expected['tracks'] = ['210', '211']
-        expected['properties'] = {'time_created': '2019-01-01T02:03:04Z'}
-        mock_put.assert_called_once_with('folder', expected)
-        mock_delete.assert_called_once_with('folder', '105')
-
-    @mock.patch.object(FakeClient, 'upload_file')
-    @mock.patch.object(FakeClient, 'create_object')
-    @mock.patch.object(FakeClient, 'delete_object')
-    def test_upload_new_folder_create_fail(self, mock_delete, mock_create,
-                                           mock_upload):
-        mock_create.return_value = None
+        self.mock_move.assert_called_once_with('105', '106')
+        self.mock_delete.assert_called_once_with('folder', '105')
+
+    def test_upload_new_folder_create_fail(self):
+        self.mock_create.return_value = None
         out = self._run('upload --new-folder foo foo.gpx',
                         expect_fail=True)
         self.assertIn('failed to create folder', out)
-        mock_delete.assert_not_called()
-
-    @mock.patch.object(FakeClient, 'upload_file')
-    @mock.patch.object(FakeClient, 'put_object')
-    @mock.patch.object(FakeClient, 'delete_object')
-    def test_upload_with_folder_move_fail(self, mock_delete, mock_put,
-                                          mock_upload):
-        mock_upload.return_value = {'id': '102',  # re-use to avoid mocks
-                                    'properties': {
-                                        'name': 'foo.gpx',
-                                    }}
-        mock_put.return_value = None
+        self.mock_delete.assert_not_called()
+
+    def test_upload_with_folder_move_fail(self):
+        self.mock_upload.return_value = {'id': '102',  # re-use to avoid mocks
+                                         'properties': {
+                                             'name': 'foo.gpx',
+                                         }}
+        self.mock_move.return_value = None
         out = self._run('upload --existing-folder folder1 foo.gpx',
                         expect_fail=True)
         self.assertIn('Failed to move', out)
-        mock_delete.assert_not_called()
+        self.mock_delete.assert_not_called()
 
-    @mock.patch('builtins.open')
-    def test_export(self, mock_open):
+    def test_export(self):
+        # Shadow open() for the command module only
+        mock_open = self._swap(command, 'open')
         out = self._run('waypoint export wpt1 foo.gpx')
         self.assertIn('Wrote \'foo.gpx\'', out)
         mock_open.assert_called_once_with('foo.gpx', 'wb')
         fake_file = mock_open.return_value.__enter__.return_value
         fake_file.write.assert_called_once_with('object 001 format gpx')
 
-        out = self._run('folder export folder1 foo.gpx')
-        self.assertIn('Wrote \'foo.gpx\'', out)
-
-        out = self._run('folder export folder1 -')
-        self.assertIn('object 101 format gpx', out)
-
-        out = self._run('track export trk1 foo.gpx')
-        self.assertIn('Wrote \'foo.gpx\'', out)
-
-        out = self._run('folder export folder1 --format kml foo.kml')
-        self.assertIn('Wrote \'foo.kml\'', out)
+        cases = [
+            ('folder export folder1 foo.gpx', 'Wrote \'foo.gpx\''),
+            ('folder export folder1 -', 'object 101 format gpx'),
+            ('track export trk1 foo.gpx', 'Wrote \'foo.gpx\''),
+            ('folder export folder1 --format kml foo.kml',
+             'Wrote \'foo.kml\''),
+        ]
+        for cmdline, expected in cases:
+            with self.subTest(cmdline=cmdline):
+                out = self._run(cmdline)
+                self.assertIn(expected, out)
 
-        out = self._run('folder export folder1 --format jpg foo',
-                        expect_fail=True)
+        self._run('folder export folder1 --format jpg foo',
+                  expect_fail=True)
 
     def test_query_hidden(self):
-        self._run('query foo',
-                  expect_fail=True)
+        self._parse('query foo')
 
-    @mock.patch.dict(os.environ, GAIAGPSCLIENTDEV='y')
     @mock.patch.object(FakeClient, 's')
     def test_query(self, mock_s):
+        self._setenv('GAIAGPSCLIENTDEV', 'y')
         mock_r = mock.MagicMock()
         mock_r.headers = {'Content-Type': 'foo json foo'}
         mock_r.status_code = 200
@@ -1237,15 +1377,13 @@ class TestShellUnit(unittest.TestCase):
         out = self._run('query api/objects/waypoint')
         self.assertIn('200 OK', out)
         self.assertIn('json', out)
-        self.assertIn('object', out)
-        mock_s.get.assert_called_once_with(
-            apiclient.gurl('api', 'objects', 'waypoint'),
-            params={})
+        self.assertIn('"object": "data"', out)
+        mock_s.get.assert_called_once_with(_WAYPOINT_URL, params={})
         mock_r.json.assert_called_once_with()
 
-    @mock.patch.dict(os.environ, GAIAGPSCLIENTDEV='y')
     @mock.patch.object(FakeClient, 's')
     def test_query_args_method_quiet(self, mock_s):
+        self._setenv('GAIAGPSCLIENTDEV', 'y')
         mock_r = mock.MagicMock()
         mock_r.headers = {'Content-Type': 'html'}
         mock_r.status_code = 200
@@ -1257,9 +1395,17 @@ class TestShellUnit(unittest.TestCase):
         self.assertNotIn('200 OK', out)
         self.assertNotIn('Content-Type', out)
         self.assertIn('foo', out)
-        mock_s.put.assert_called_once_with(
-            apiclient.gurl('api', 'objects', 'waypoint'),
-            params={'foo': 'bar'})
+        mock_s.put.assert_called_once_with(_WAYPOINT_URL,
+                                           params={'foo': 'bar'})
+
+    @mock.patch.object(FakeClient, 's')
+    def test_query_args_parsing(self, mock_s):
+        self._setenv('GAIAGPSCLIENTDEV', 'y')
+        mock_s.get.return_value.headers = {}
+        self._run('query /api/objects/ -a foo=a=b bar -q')
+        mock_s.get.assert_called_once_with(
+            apiclient.gurl('api', 'objects'),
+            params={'foo': 'a=b', 'bar': ''})
 
     def test_url(self):
         out = self._run('waypoint url wpt1')
@@ -1268,25 +1414,21 @@ class TestShellUnit(unittest.TestCase):
 
     def test_dump(self):
         out = self._run('waypoint dump wpt1')
-        self.assertEqual(
-            pprint.pformat(
-                FakeClient().get_object('waypoint', 'wpt1')),
-            out.strip())
-
-    @mock.patch.object(FakeClient, 'test_auth')
-    def test_test(self, mock_test):
-        mock_test.return_value = True
+        self.assertEqual(FakeClient().get_object('waypoint', 'wpt1'),
+                         ast.literal_eval(out.strip()))
+
+    def test_test(self):
+        self.mock_test.return_value = True
         out = self._run('test')
         self.assertEqual('Success!', out.strip())
 
-        mock_test.return_value = False
+        self.mock_test.return_value = False
         out = self._run('test',
                         expect_fail=True)
         self.assertEqual('Unable to access gaia', out.strip())
 
-    @mock.patch.object(FakeClient, 'test_auth')
-    def test_with_debug(self, mock_test):
-        mock_test.return_value = True
+    def test_with_debug(self):
+        self.mock_test.return_value = True
         self._run('--debug test')
 
     @mock.patch.object(FakeClient, '__init__')
@@ -1296,12 +1438,16 @@ class TestShellUnit(unittest.TestCase):
                         expect_fail=True)
         self.assertIn('Unable to access Gaia', out)
 
+    def test_no_user_skips_tty_check(self):
+        mock_tty = self._swap(os, 'isatty')
+        self.mock_test.return_value = True
+        self._run('test')
+        mock_tty.assert_not_called()
+
     @mock.patch('getpass.getpass')
-    @mock.patch('os.isatty')
     @mock.patch.object(FakeClient, '__init__')
-    @mock.patch.object(FakeClient, 'test_auth')
-    def test_get_pass(self, mock_test, mock_client, mock_tty, mock_getpass):
-        mock_tty.return_value = True
+    def test_get_pass(self, mock_client, mock_getpass):
+        self._swap(os, 'isatty', lambda fd: True)
         mock_getpass.return_value = mock.sentinel.password
         mock_client.return_value = None
         self._run('--user foo@bar.com test')
@@ -1389,77 +1535,89 @@ class TestShellUnit(unittest.TestCase):
         self.assertIn('folder1', out)
         self.assertIn('21 Oct', out)
 
-    @mock.patch.object(FakeClient, 'put_object')
-    def test_colorize_track(self, mock_put):
+    def test_tree_cache(self):
+        with mock.patch.object(FakeClient, 'list_objects',
+                               wraps=FakeClient().list_objects) as mock_list:
+            self._run('tree')
+            mock_list.assert_any_call('folder', max_age=60)
+            mock_list.reset_mock()
+            self._run('tree --no-cache')
+            mock_list.assert_any_call('folder', max_age=None)
+
+    def test_tree_no_folder_fetch(self):
+        with mock.patch.object(FakeClient, 'get_object') as mock_get:
+            out = self._run('tree')
+        mock_get.assert_not_called()
+        self.assertIn('[W] wpt3', out)
+
+    def test_colorize_track(self):
         # Bad color
         out = self._run('track colorize --color red trk1',
                         expect_fail=True)
         self.assertIn('Invalid color code', out)
-        mock_put.assert_not_called()
+        self.mock_put.assert_not_called()
 
         # No match
         out = self._run('track colorize --color #ff0000 notrk',
                         expect_fail=True)
         self.assertIn('not found', out)
-        mock_put.assert_not_called()
+        self.mock_put.assert_not_called()
 
         # No pattern match
         out = self._run('track colorize --color #ff0000 --match notrk',
                         expect_fail=True)
         self.assertIn('No matching', out)
-        mock_put.assert_not_called()
+        self.mock_put.assert_not_called()
 
         # Change with proper code
         out = self._run('track colorize --color #ff0000 trk1')
         self.assertEqual('', out)
-        mock_put.assert_called_once_with('track', {'id': '201',
-                                                   'color': '#ff0000'})
+        self.mock_put.assert_called_once_with('track', {'id': '201',
+                                                        'color': '#ff0000'})
 
         # Change honors dry-run
-        mock_put.reset_mock()
+        self.mock_put.reset_mock()
         out = self._run('track colorize --dry-run --color #ff0000 trk1')
         self.assertEqual('', out)
-        mock_put.assert_not_called()
+        self.mock_put.assert_not_called()
 
         # Change with missing hash grace
-        mock_put.reset_mock()
+        self.mock_put.reset_mock()
         out = self._run('track colorize --color ff0000 trk1')
         self.assertEqual('', out)
-        mock_put.assert_called_once_with('track', {'id': '201',
-                                                   'color': '#ff0000'})
+        self.mock_put.assert_called_once_with('track', {'id': '201',
+                                                        'color': '#ff0000'})
 
         # Failed PUT reports failure
-        mock_put.reset_mock()
-        mock_put.return_value = False
+        self.mock_put.reset_mock()
+        self.mock_put.return_value = False
         out = self._run('track colorize --color ff0000 trk1',
                         expect_fail=True)
         self.assertIn('Failed to set track', out)
 
     @mock.patch('random.choice')
-    @mock.patch.object(FakeClient, 'put_object')
-    def test_colorize_track_random(self, mock_put, mock_choice):
+    def test_colorize_track_random(self, mock_choice):
         out = self._run('track colorize --random notrk',
                         expect_fail=True)
         self.assertIn('not found', out)
-        mock_put.assert_not_called()
+        self.mock_put.assert_not_called()
 
         out = self._run('track colorize --random --match notrk',
                         expect_fail=True)
         self.assertIn('No matching', out)
-        mock_put.assert_not_called()
+        self.mock_put.assert_not_called()
 
         mock_choice.side_effect = ['color1', 'color2']
         out = self._run('track colorize --random trk1 trk2')
         self.assertEqual('', out)
         self.assertTrue(mock_choice.called)
-        mock_put.assert_any_call('track', {'id': '201',
-                                           'color': 'color1'})
-        mock_put.assert_any_call('track', {'id': '202',
-                                           'color': 'color2'})
+        self.mock_put.assert_any_call('track', {'id': '201',
+                                                'color': 'color1'})
+        self.mock_put.assert_any_call('track', {'id': '202',
+                                                'color': 'color2'})
 
     @mock.patch('gaiagps.util.get_track_colors_from_gpx')
-    @mock.patch.object(FakeClient, 'put_object')
-    def test_colorize_track_from_gpx(self, mock_put, mock_get_tracks):
+    def test_colorize_track_from_gpx(self, mock_get_tracks):
         mock_get_tracks.return_value = {
             'trk1': 'Red',
             'trk3': 'Green',
@@ -1469,55 +1627,55 @@ class TestShellUnit(unittest.TestCase):
         out = self._run('track colorize --from-gpx-file foo.gpx --match notrk',
                         expect_fail=True)
         self.assertIn('No matching', out)
-        mock_put.assert_not_called()
+        self.mock_put.assert_not_called()
 
         # Explicit, runs one
         out = self._run('track colorize --from-gpx-file foo.gpx trk1')
         self.assertEqual('', out)
-        mock_put.assert_called_once_with('track', {'id': '201',
-                                                   'color': '#F90553'})
+        self.mock_put.assert_called_once_with('track', {'id': '201',
+                                                        'color': '#F90553'})
 
         # Match that matches some not found in the gpx data
-        mock_put.reset_mock()
+        self.mock_put.reset_mock()
         out = self._run('--verbose track colorize --from-gpx-file foo.gpx '
                         '--match trk')
         self.assertIn('\'trk2\' not found in GPX file', out)
         self.assertIn('Coloring track \'trk1\'', out)
-        mock_put.assert_any_call('track', {'id': '201',
-                                           'color': '#F90553'})
+        self.mock_put.assert_any_call('track', {'id': '201',
+                                                'color': '#F90553'})
 
         # Run all found in the gpx data
-        mock_put.reset_mock()
+        self.mock_put.reset_mock()
         out = self._run('--verbose track colorize --from-gpx-file foo.gpx')
         self.assertIn('Coloring track \'trk1\'', out)
         self.assertNotIn('trk3', out)
-        mock_put.assert_any_call('track', {'id': '201',
-                                           'color': '#F90553'})
+        self.mock_put.assert_any_call('track', {'id': '201',
+                                                'color': '#F90553'})
 
         # In folder only selects the right tracks
         mock_get_tracks.return_value = {'trk1': 'Green',
                                         'trk2': 'Red'}
-        mock_put.reset_mock()
+        self.mock_put.reset_mock()
         self._run('--verbose track colorize --from-gpx-file foo.gpx '
                   '--in-folder folder2')
-        mock_put.assert_called_once_with('track', {'id': '202',
-                                                   'color': '#F90553'})
+        self.mock_put.assert_called_once_with('track', {'id': '202',
+                                                        'color': '#F90553'})
 
         # No tracks in gpx data
         mock_get_tracks.return_value = {}
-        mock_put.reset_mock()
+        self.mock_put.reset_mock()
         out = self._run('--verbose track colorize --from-gpx-file foo.gpx',
                         expect_fail=True)
         self.assertIn('No colored tracks found', out)
-        mock_put.assert_not_called()
+        self.mock_put.assert_not_called()
 
         # Tracks in gpx, but no matching
         mock_get_tracks.return_value = {'notrk': 'foo'}
-        mock_put.reset_mock()
+        self.mock_put.reset_mock()
         out = self._run('--verbose track colorize --from-gpx-file foo.gpx',
                         expect_fail=True)
         self.assertIn('No matching objects', out)
-        mock_put.assert_not_called()
+        self.mock_put.assert_not_called()
 
     @mock.patch('gaiagps.util.date_parse')
     @mock.patch('os.utime')
@@ -1567,6 +1725,179 @@ class TestShellUnit(unittest.TestCase):
         self.assertIn('admin', out)
 
 
+class TestCookieJarUnit(unittest.TestCase):
+    def setUp(self):
+        super(TestCookieJarUnit, self).setUp()
+        fd, self.cookiepath = tempfile.mkstemp()
+        os.close(fd)
+        os.remove(self.cookiepath)
+        self.addCleanup(lambda: os.path.exists(self.cookiepath) and
+                        os.remove(self.cookiepath))
+        patcher = mock.patch('os.path.expanduser',
+                             return_value=self.cookiepath)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _cookie(self, value):
+        return http.cookiejar.Cookie(
+            0, 'session', value, None, False, '.gaiagps.com', True, True,
+            '/', True, False, int(time.time()) + 3600, False, None, None, {})
+
+    def test_save_only_when_changed(self):
+        with shell.cookiejar() as jar:
+            jar.set_cookie(self._cookie('foo'))
+        self.assertTrue(os.path.exists(self.cookiepath))
+
+        with mock.patch('http.cookiejar.LWPCookieJar.save') as mock_save:
+            with shell.cookiejar() as jar:
+                self.assertEqual(1, len(jar))
+            mock_save.assert_not_called()
+
+            with shell.cookiejar() as jar:
+                jar.set_cookie(self._cookie('bar'))
+            mock_save.assert_called_once_with()
+
+
+@unittest.skipUnless(daemon.supported(), 'Daemon mode not supported')
+class TestDaemonUnit(unittest.TestCase):
+    def setUp(self):
+        super(TestDaemonUnit, self).setUp()
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(os.rmdir, tmpdir)
+        self.sockpath = os.path.join(tmpdir, 'sock')
+        patcher = mock.patch.object(daemon, 'socket_path',
+                                    return_value=self.sockpath)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_forward_not_running(self):
+        self.assertIsNone(daemon.forward(['test']))
+
+    def test_forward(self):
+        sock = daemon.listen()
+        self.assertIsNotNone(sock)
+        # Only one of us may run at a time
+        self.assertIsNone(daemon.listen())
+
+        def fake_main(argv):
+            os.write(1, ('%s %s' % (argv, os.getcwd())).encode())
+            return 3
+
+        server = threading.Thread(target=daemon.serve,
+                                  args=(sock, fake_main),
+                                  kwargs={'idle_timeout': 0.5})
+        server.start()
+
+        out_r, out_w = os.pipe()
+        in_r, in_w = os.pipe()
+        with contextlib.ExitStack() as stack:
+            fake_stdin = stack.enter_context(os.fdopen(in_r))
+            fake_stdout = stack.enter_context(os.fdopen(out_w, 'w'))
+            with mock.patch.multiple('sys', stdin=fake_stdin,
+                                     stdout=fake_stdout,
+                                     stderr=fake_stdout):
+                rc = daemon.forward(['gaiagps', 'waypoint', 'list'])
+            server.join()
+        os.close(in_w)
+        with os.fdopen(out_r) as f:
+            out = f.read()
+
+        self.assertEqual(3, rc)
+        self.assertEqual("['waypoint', 'list'] %s" % os.getcwd(), out)
+        # Cleaned up after going idle
+        self.assertFalse(os.path.exists(self.sockpath))
+
+    def _serve_one(self, fake_main):
+        sock = daemon.listen()
+        server = threading.Thread(target=daemon.serve,
+                                  args=(sock, fake_main),
+                                  kwargs={'idle_timeout': 0.5})
+        server.start()
+        with open(os.devnull, 'r+') as null:
+            with mock.patch.multiple('sys', stdin=null, stdout=null,
+                                     stderr=null):
+                rc = daemon.forward(['gaiagps', 'test'])
+        server.join()
+        return rc
+
+    def test_forward_unsupported_stdio(self):
+        sock = daemon.listen()
+        self.addCleanup(os.unlink, self.sockpath)
+        self.addCleanup(sock.close)
+        # No file descriptors to hand over, so the command runs here
+        with mock.patch('sys.stdin', new=io.StringIO()):
+            self.assertIsNone(daemon.forward(['gaiagps', 'test']))
+
+    def test_handle_restores_debug(self):
+        root_logger = logging.getLogger()
+        level = root_logger.level
+        debuglevel = http.client.HTTPConnection.debuglevel
+
+        def fake_main(argv):
+            root_logger.setLevel(logging.DEBUG)
+            http.client.HTTPConnection.debuglevel = debuglevel + 1
+            sys.exit()
+
+        # A bare sys.exit() is success
+        self.assertEqual(0, self._serve_one(fake_main))
+        self.assertEqual(level, root_logger.level)
+        self.assertEqual(debuglevel, http.client.HTTPConnection.debuglevel)
+
+    def test_handle_forgets_environment(self):
+        with mock.patch('os.access', return_value=True):
+            with mock.patch.dict(os.environ, EDITOR='/old/editor'):
+                self.assertEqual('/old/editor', util.get_editor())
+            self.addCleanup(util.get_editor.cache_clear)
+            editors = []
+
+            def fake_main(argv):
+                editors.append(util.get_editor())
+
+            with mock.patch.dict(os.environ, EDITOR='/new/editor'):
+                self._serve_one(fake_main)
+        self.assertEqual(['/new/editor'], editors)
+
+    def test_handle_restores_process_state(self):
+        argv = sys.argv
+        cwd = os.getcwd()
+        environ = dict(os.environ)
+        seen = []
+
+        def fake_main(argv):
+            seen.append(sys.argv)
+            os.chdir('/')
+            os.environ['GAIAGPS_TEST'] = 'leaked'
+
+        with mock.patch.dict(os.environ, GAIAGPS_DAEMON_TEST='caller'):
+            self._serve_one(fake_main)
+            self.assertEqual('caller', os.environ['GAIAGPS_DAEMON_TEST'])
+        self.assertEqual([['gaiagps', 'test']], seen)
+        self.assertIs(argv, sys.argv)
+        self.assertEqual(cwd, os.getcwd())
+        self.assertEqual(environ, dict(os.environ))
+
+    def test_no_forward_for_login(self):
+        self.assertTrue(shell._wants_login(['gaiagps', '--user', 'u', 'test']))
+        self.assertTrue(shell._wants_login(['gaiagps', '--user=u', 'test']))
+        self.assertFalse(shell._wants_login(['gaiagps', 'test']))
+
+    def test_save_cookies_unless_replaced(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            jar = mock.MagicMock()
+            jar.filename = os.path.join(tmpdir, 'cookies')
+            with open(jar.filename, 'w') as f:
+                f.write('ours')
+            save = shell._save_cookies_unless_replaced(jar)
+            save()
+            jar.save.assert_called_once_with()
+
+            # Someone else logged in meanwhile
+            jar.save.reset_mock()
+            os.utime(jar.filename, (0, 0))
+            save()
+            jar.save.assert_not_called()
+
+
 class TestShellFunctional(test_apiclient.BaseClientFunctional):
     @mock.patch.object(shell, 'cookiejar')
     def _run(self, cmdline, mock_cookies, expect_fail=False):
@@ -1574,7 +1905,8 @@ class TestShellFunctional(test_apiclient.BaseClientFunctional):
         out = FakeOutput()
         with mock.patch.multiple('sys', stdout=out, stderr=out, stdin=out):
             rc = shell.main(shlex.split(cmdline))
-        print(out.getvalue())
+        if _DEBUG:
+            print(out.getvalue())
         if not expect_fail:
             self.assertEqual(0, rc)
         else:
@@ -1591,7 +1923,7 @@ class TestShellFunctional(test_apiclient.BaseClientFunctional):
         self.addCleanup(lambda: os.remove(tmp))
         import_folder_name = _test_name('import')
         self._run('folder rename "%s" "%s"' % (
-            'clean-%s' % os.path.basename(tmp), import_folder_name))
+            os.path.basename(tmp), import_folder_name))
         return tmp, import_folder_name
 
     def test_track_ops(self):
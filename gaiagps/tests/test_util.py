@@ -4,21 +4,30 @@ import io
 import mock
 import os
 import pytz
+import sys
 import unittest
 
 from gaiagps import util
 
 
 class TestUtilUnit(unittest.TestCase):
+    def _clear_date_caches(self):
+        # Do not use (or leave behind) stamps formatted for another zone
+        util._fmt_datestamp.cache_clear()
+        self.addCleanup(util._fmt_datestamp.cache_clear)
+
     @mock.patch('tzlocal.get_localzone')
     def test_date_parse(self, mock_get_localzone):
         hill_valley = pytz.timezone('America/Los_Angeles')
         mock_get_localzone.return_value = hill_valley
+        self._clear_date_caches()
 
         expected = hill_valley.localize(
             datetime.datetime(2015, 10, 21, 16, 29))
         formats = ['2015-10-21T23:29:00Z',
                    '2015-10-21T23:29:00.00',
+                   '2015-10-21T23:29:00.000000',
+                   '2015-10-21T23:29:00+00:00',
                    '2015-10-21T23:29:00']
         for i in formats:
             self.assertEqual(expected,
@@ -27,10 +36,23 @@ class TestUtilUnit(unittest.TestCase):
                              util.date_parse({'properties': {
                                  'time_created': i}}))
 
+    @mock.patch('tzlocal.get_localzone')
+    def test_date_parse_stdlib_zone(self, mock_get_localzone):
+        # Newer tzlocal returns zoneinfo zones rather than pytz ones
+        pdt = datetime.timezone(datetime.timedelta(hours=-7))
+        mock_get_localzone.return_value = pdt
+        self._clear_date_caches()
+
+        dt = util.date_parse({'time_created': '2015-10-21T23:29:00Z'})
+        self.assertEqual(datetime.datetime(2015, 10, 21, 16, 29, tzinfo=pdt),
+                         dt)
+        self.assertEqual(pdt, dt.tzinfo)
+
     @mock.patch('tzlocal.get_localzone')
     def test_datefmt(self, mock_get_localzone):
         hill_valley = pytz.timezone('America/Los_Angeles')
         mock_get_localzone.return_value = hill_valley
+        self._clear_date_caches()
 
         expected = '21 Oct 2015 16:29:00'
         formats = ['2015-10-21T23:29:00Z',
@@ -42,6 +64,18 @@ class TestUtilUnit(unittest.TestCase):
             self.assertEqual(expected,
                              util.datefmt({'properties': {'time_created': i}}))
 
+    def test_get_datestamp(self):
+        ds = '2015-10-21T23:29:00Z'
+        self.assertEqual(ds, util.get_datestamp({'time_created': ds}))
+        self.assertEqual(ds, util.get_datestamp(
+            {'properties': {'time_created': ds}}))
+        self.assertEqual(ds, util.get_datestamp(
+            {'features': [{'properties': {'time_created': ds}}]}))
+        self.assertEqual(ds, util.get_datestamp(
+            {'properties': {'updated_date': ds}}, 'updated_date'))
+        self.assertIsNone(util.get_datestamp({'properties': {}}))
+        self.assertIsNone(util.get_datestamp({}))
+
     def test_title_sort(self):
         self.assertEqual([{'title': 'abc'}, {'title': 'def'}],
                          util.title_sort([
@@ -52,6 +86,15 @@ class TestUtilUnit(unittest.TestCase):
                          util.name_sort([
                              {'name': 'def'}, {'name': 'abc'}]))
 
+    def test_icon_names(self):
+        for alias, filename in util.ICON_ALIASES.items():
+            self.assertEqual(alias, util.ICON_NAMES[filename])
+
+    def test_canonical_icon(self):
+        self.assertEqual('fuel-24.png', util.canonical_icon('fuel'))
+        self.assertEqual('fuel-24.png', util.canonical_icon('fuel-24.png'))
+        self.assertIsNone(util.canonical_icon('fuell'))
+
     def test_is_id(self):
         ids = ['0b00901f6549abf8a8b7de8b49d24894',
                '0c94be3d-6fd9-45a0-9ca5-e8fd6969b7d3']
@@ -100,6 +143,25 @@ class TestUtilUnit(unittest.TestCase):
         for i in invalid:
             self.assertRaises(ValueError, util.validate_alt, i)
 
+    def test_validate_numeric(self):
+        self.assertEqual(45.5, util.validate_lat(45.5))
+        self.assertIsInstance(util.validate_lat(45), float)
+        self.assertEqual(-120.5, util.validate_lon(-120.5))
+        self.assertIsInstance(util.validate_lon(-120), float)
+        self.assertEqual(900, util.validate_alt(900))
+        alt = util.validate_alt(True)
+        self.assertEqual(1, alt)
+        self.assertIs(int, type(alt))
+        self.assertRaises(ValueError, util.validate_lat, 90.1)
+        self.assertRaises(ValueError, util.validate_lon, -181.0)
+        self.assertRaises(ValueError, util.validate_alt, -1)
+
+    def test_validate_nan(self):
+        # NaN is not in any range
+        for i in ('nan', float('nan')):
+            self.assertRaises(ValueError, util.validate_lat, i)
+            self.assertRaises(ValueError, util.validate_lon, i)
+
     def _test_folders(self):
         folders = [
             {'id': '1', 'parent': None, 'name': 'root1', 'properties': {
@@ -172,16 +234,76 @@ class TestUtilUnit(unittest.TestCase):
             [{'id': '202', 'title': 'track_202', 'properties': {}}],
             subsub['properties']['tracks'])
 
+    def test_resolve_tree_subfolder(self):
+        folders = self._test_folders()
+        fake_client = mock.MagicMock()
+        fake_client.get_object.side_effect = lambda t, id_: {
+            'id': id_, 'fetched': True}
+
+        tree = util.make_tree(folders)
+        sub = util.resolve_tree(fake_client, tree['subfolders']['3'])
+
+        # Every folder below the starting one is fetched once, and we
+        # never need the lists for the root
+        self.assertEqual(['2', '3', '4'],
+                         sorted(c[1]['id_'] for c in
+                                fake_client.get_object.call_args_list))
+        fake_client.list_objects.assert_not_called()
+        self.assertTrue(sub['subfolders']['2']['subfolders']['4']['fetched'])
+
+    def test_resolve_tree_from_lists(self):
+        folders = self._test_folders()
+        for folder in folders:
+            folder['waypoints'] = folder['properties'].pop('waypoints')
+            folder['tracks'] = folder['properties'].pop('tracks')
+        waypoints = [{'id': i, 'title': 'waypoint_%s' % i, 'folder': f}
+                     for i, f in [('100', '1'), ('101', '1'),
+                                  ('102', '2'), ('103', '')]]
+        tracks = [{'id': i, 'title': 'track_%s' % i, 'folder': f}
+                  for i, f in [('200', '1'), ('201', '1'), ('202', '4'),
+                               ('203', None)]]
+
+        fake_client = mock.MagicMock()
+        tree = util.make_tree(folders)
+        resolved = util.resolve_tree(fake_client, tree,
+                                     waypoints=waypoints, tracks=tracks)
+        fake_client.get_object.assert_not_called()
+        fake_client.list_objects.assert_not_called()
+
+        self.assertEqual([waypoints[3]],
+                         resolved['properties']['waypoints'])
+        # A null folder is also the root
+        self.assertEqual([tracks[3]], resolved['properties']['tracks'])
+        sub = resolved['subfolders']['3']['subfolders']['2']
+        self.assertEqual([waypoints[2]], sub['properties']['waypoints'])
+        subsub = sub['subfolders']['4']
+        self.assertEqual([tracks[2]], subsub['properties']['tracks'])
+
+    def test_resolve_tree_from_lists_deep(self):
+        # Deeper than the recursion limit
+        depth = sys.getrecursionlimit() + 10
+        folders = [{'id': str(i), 'parent': str(i - 1) if i else None,
+                    'title': 'f%i' % i, 'waypoints': [], 'tracks': []}
+                   for i in range(depth)]
+        folders[-1]['waypoints'] = ['100']
+        waypoints = [{'id': '100', 'title': 'bottom',
+                      'folder': folders[-1]['id']}]
+
+        tree = util.make_tree(folders)
+        resolved = util.resolve_tree(mock.MagicMock(), tree,
+                                     waypoints=waypoints, tracks=[])
+        self.assertEqual(waypoints,
+                         folders[-1]['properties']['waypoints'])
+        self.assertEqual('/', resolved['properties']['name'])
+        lines = list(util.folder_lines(resolved))
+        self.assertEqual(depth + 2, len(lines))
+
     def test_pprint_folder(self):
         resolved = self._test_resolve_tree()
-        with mock.patch('builtins.print') as mock_print:
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as out:
             util.pprint_folder(resolved)
 
-        lines = []
-        for call in mock_print.call_args_list:
-            lines.append(call[0][0] if call[0] else '')
-
-        output = ''.join(lines)
+        output = out.getvalue()
 
         # Check some things at the root and at the leaves for proper
         # nesting
@@ -190,11 +312,42 @@ class TestUtilUnit(unittest.TestCase):
         self.assertIn('subsub/', output)
         self.assertIn('[T] track_202', output)
 
+    def test_folder_lines(self):
+        resolved = self._test_resolve_tree()
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as out:
+            util.pprint_folder(resolved)
+        lines = list(util.folder_lines(resolved))
+        self.assertEqual(out.getvalue(), '\n'.join(lines) + '\n')
+        self.assertEqual('/', lines[0])
+
+        # Nested output starts with a subfolder line, not the root
+        lines = list(util.folder_lines(resolved['subfolders']['3'],
+                                       indent=4))
+        self.assertEqual('    \u251c\u2500\u2500 subfolder/', lines[0])
+
+    def test_pprint_folder_deep(self):
+        # Deeper than the recursion limit
+        depth = sys.getrecursionlimit() + 10
+        root = {'properties': {'waypoints': [], 'tracks': []}}
+        folder = root
+        for i in range(depth):
+            sub = {'title': 'f%i' % i,
+                   'properties': {'waypoints': [], 'tracks': []}}
+            folder['subfolders'] = {str(i): sub}
+            folder = sub
+        folder['properties']['waypoints'].append({'title': 'bottom'})
+
+        lines = list(util.folder_lines(root))
+        self.assertEqual(depth + 2, len(lines))
+        self.assertEqual('%s\u2514\u2500\u2500 [W] bottom' % (' ' * 4 * depth),
+                         lines[-1])
+
     @mock.patch('os.environ')
     @mock.patch('os.access')
     def test_get_editor(self, mock_access, mock_environ):
         mock_access.return_value = True
         mock_environ.get.return_value = '/foo/bar'
+        util.get_editor.cache_clear()
 
         # Editor exists, should return it
         editor = util.get_editor()
@@ -203,10 +356,17 @@ class TestUtilUnit(unittest.TestCase):
                                                  '/usr/bin/editor')
         mock_access.assert_called_once_with('/foo/bar', os.X_OK)
 
+        # Cached, so we do not look again
+        editor = util.get_editor()
+        self.assertEqual('/foo/bar', editor)
+        mock_access.assert_called_once_with('/foo/bar', os.X_OK)
+
         # Does not exist or not executable
+        util.get_editor.cache_clear()
         mock_access.return_value = False
         editor = util.get_editor()
         self.assertIsNone(editor)
+        util.get_editor.cache_clear()
 
     @mock.patch('builtins.open')
     def test_strip_gpx_extensions(self, mock_open):
@@ -221,6 +381,16 @@ class TestUtilUnit(unittest.TestCase):
         self.assertIn('<wpt', output.getvalue())
         self.assertNotIn('<extensions>', output.getvalue())
 
+    def test_strip_gpx_extensions_fileobj(self):
+        output = io.BytesIO()
+        with mock.patch('builtins.open') as mock_open:
+            mock_open.return_value = io.BytesIO(GPX_WITH_EXTENSIONS.encode())
+            util.strip_gpx_extensions('input-file', output)
+            mock_open.assert_called_once_with('input-file', 'rb')
+
+        self.assertIn(b'<wpt', output.getvalue())
+        self.assertNotIn(b'<extensions>', output.getvalue())
+
     @mock.patch('builtins.open')
     def test_strip_gpx_extensions_errors(self, mock_open):
         input = io.BytesIO(b'foo')
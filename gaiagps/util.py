@@ -1,14 +1,21 @@
+import collections
+import concurrent.futures
 import datetime
 import functools
+import itertools
 import logging
+import operator
 import os
-import pytz
 import string
+import sys
 import tzlocal
 from xml.etree import ElementTree as ET
 
 LOG = logging.getLogger(__name__)
 
+# Number of folders resolve_tree() fetches at once
+RESOLVE_WORKERS = 8
+
 
 ICON_ALIASES = {
     'blue': 'blue-pin-down.png',
@@ -70,6 +77,14 @@ ICON_ALIASES = {
     'wetland': 'wetland-24.png',
 }
 
+# The reverse of ICON_ALIASES, for showing icon filenames by alias
+ICON_NAMES = {filename: alias for alias, filename in ICON_ALIASES.items()}
+
+# Every name we know for an icon, mapped to its filename
+_ICON_CANONICAL = dict(ICON_ALIASES)
+_ICON_CANONICAL.update((filename, filename)
+                       for filename in ICON_ALIASES.values())
+
 
 COLOR_ALIASES = {
     'red': '#F42410',
@@ -117,6 +132,32 @@ GPXX_COLORS_TO_GAIA = {
 }
 
 
+def get_datestamp(thing, property_name='time_created'):
+    """Find the raw datestamp string in a thing.
+
+    This looks for ``property_name`` at the top level of the object,
+    then in its ``properties``, and finally in the properties of its
+    first feature.
+
+    :param thing: A raw object from the API
+    :type thing: dict
+    :returns: The datestamp string or None if one is not found
+    :rtype: `str`
+    """
+    if property_name in thing:
+        return thing[property_name]
+    elif 'properties' in thing:
+        return thing['properties'].get(property_name)
+    elif 'features' in thing:
+        return thing['features'][0]['properties'].get(property_name)
+
+
+# Datestamps from the API, without any fraction or zone suffix
+_DATE_IN = '%Y-%m-%dT%H:%M:%S'
+# How we show dates to the user
+_DATE_OUT = '%d %b %Y %H:%M:%S'
+
+
 def date_parse(thing, property_name='time_created'):
     """Parse a local datetime from a thing with a datestamp.
 
@@ -132,28 +173,37 @@ def date_parse(thing, property_name='time_created'):
     :returns: A localized tz-aware `datetime` or None if no datestamp is found.
     :rtype: :class:`datetime.datetime`
     """
-    if property_name in thing:
-        ds = thing[property_name]
-    elif 'properties' in thing:
-        ds = thing['properties'].get(property_name)
-    elif 'features' in thing:
-        ds = thing['features'][0]['properties'].get(property_name)
-    else:
-        ds = None
+    ds = get_datestamp(thing, property_name)
     if not ds:
         return None
+    return _parse_datestamp(ds)
 
-    if 'Z' in ds:
-        dt = datetime.datetime.strptime(ds, '%Y-%m-%dT%H:%M:%SZ')
-    elif '.' in ds:
-        dt = datetime.datetime.strptime(ds, '%Y-%m-%dT%H:%M:%S.%f')
-    else:
-        dt = datetime.datetime.strptime(ds, '%Y-%m-%dT%H:%M:%S')
 
-    dt = pytz.utc.localize(dt)
+def _parse_datestamp(ds):
+    try:
+        dt = datetime.datetime.fromisoformat(ds.replace('Z', '+00:00'))
+    except (AttributeError, ValueError):
+        # No fromisoformat() before python 3.7, and it only takes some
+        # fraction widths before 3.11
+        if 'Z' in ds:
+            fmt = _DATE_IN + 'Z'
+        elif '.' in ds:
+            fmt = _DATE_IN + '.%f'
+        else:
+            fmt = _DATE_IN
+        dt = datetime.datetime.strptime(ds, fmt)
+
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
     return dt.astimezone(tzlocal.get_localzone())
 
 
+# Listings format the same few stamps over and over
+@functools.lru_cache(maxsize=4096)
+def _fmt_datestamp(ds):
+    return _parse_datestamp(ds).strftime(_DATE_OUT)
+
+
 def datefmt(thing, property_name='time_created'):
     """Nicely format a thing with a datestamp.
 
@@ -165,13 +215,24 @@ def datefmt(thing, property_name='time_created'):
               or is parseable
     :rtype: `str`
     """
-    localdt = date_parse(thing, property_name=property_name)
-    if localdt:
-        return localdt.strftime('%d %b %Y %H:%M:%S')
+    ds = get_datestamp(thing, property_name)
+    if ds:
+        return _fmt_datestamp(ds)
     else:
         return '?'
 
 
+def canonical_icon(name):
+    """Return the icon filename for an alias or known filename.
+
+    :param name: An alias from :data:`ICON_ALIASES` or an icon filename
+    :type name: str
+    :returns: The icon filename, or ``None`` if ``name`` is not a known icon
+    :rtype: `str`
+    """
+    return _ICON_CANONICAL.get(name)
+
+
 def make_waypoint(name, lat, lon, alt=0, notes='', icon=''):
     """Make a raw waypoint object.
 
@@ -232,75 +293,135 @@ def make_tree(folders):
     :returns: A hierarchical ``dict`` of folders
     :rtype: `dict`
     """
-    folders_by_id = {folder['id']: folder
-                     for folder in folders}
     root = {
         'properties': {
             'name': '/',
             'waypoints': {},
             'tracks': {},
         },
+        'subfolders': {},
     }
 
+    folders_by_id = {}
+    for folder in folders:
+        folder.setdefault('subfolders', {})
+        folders_by_id[folder['id']] = folder
+
     for folder in folders:
         if folder.get('parent'):
             parent = folders_by_id[folder['parent']]
         else:
             parent = root
-
-        parent.setdefault('subfolders', {})
         parent['subfolders'][folder['id']] = folder
 
     return root
 
 
-def resolve_tree(client, folder):
+def resolve_tree(client, folder, waypoints=None, tracks=None):
     """Walk the tree and flesh out folders with waypoint/track data.
 
     This takes a hierarchical folder tree from :func:`make_tree` and
     replaces the folder descriptions with full definitions, as you
     would get from :func:`~gaiagps.apiclient.GaiaClient.get_object`.
 
+    If ``waypoints`` and ``tracks`` are provided, the folder contents
+    are looked up in those lists by id instead of fetching every
+    folder from the server. The folders keep their list form in that
+    case, with only the ``waypoints`` and ``tracks`` properties filled
+    in, which is enough for :func:`pprint_folder`.
+
     :param client: An instance of :class:`~gaiagps.apiclient.GaiaClient`
     :type client: GaiaClient
     :param folder: A root folder of a hierarchical tree from
                    :func:`make_tree`
     :type folder: dict
+    :param waypoints: An optional list of all waypoints, like you get
+                      from :func:`~gaiagps.apiclient.GaiaClient.list_objects`
+    :type waypoints: list
+    :param tracks: An optional list of all tracks
+    :type tracks: list
     :returns: A hierarchical tree of full folder definitions.
     :rtype: `dict`
     """
 
+    if waypoints is not None and tracks is not None:
+        LOG.debug('Resolving tree from %i waypoints and %i tracks',
+                  len(waypoints), len(tracks))
+        _resolve_from_lists(folder,
+                            {w['id']: w for w in waypoints},
+                            {t['id']: t for t in tracks},
+                            waypoints, tracks)
+        return folder
+
+    def fetch(node):
+        LOG.debug('Resolving %s', node['id'])
+        return client.get_object('folder', id_=node['id'])
+
     if 'id' in folder:
-        LOG.debug('Resolving %s' % folder['id'])
-        updated = client.get_object('folder', id_=folder['id'])
-        subf = folder.get('subfolders', {})
-        folder.clear()
-        folder.update(updated)
-        folder['subfolders'] = subf
+        level = [folder]
     else:
         # This is the fake root folder
         LOG.debug('Resolving root folder (by force)')
         folder['properties']['waypoints'] = [
             w for w in client.list_objects('waypoint')
-            if w['folder'] == '']
+            if not w['folder']]
         folder['properties']['tracks'] = [
             t for t in client.list_objects('track')
-            if t['folder'] == '']
-
-    for subfolder in folder.get('subfolders', {}).values():
-        LOG.debug('Descending into %s' % subfolder['id'])
-        resolve_tree(client, subfolder)
+            if not t['folder']]
+        level = list(folder.get('subfolders', {}).values())
+
+    # Each folder is a separate request, so fetch a whole level of the
+    # tree at a time in parallel
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=RESOLVE_WORKERS) as pool:
+        while level:
+            next_level = []
+            for node, updated in zip(level, pool.map(fetch, level)):
+                subf = node.get('subfolders', {})
+                node.clear()
+                node.update(updated)
+                node['subfolders'] = subf
+                next_level.extend(subf.values())
+            level = next_level
 
     return folder
 
 
+def _resolve_from_lists(folder, waypoints_by_id, tracks_by_id,
+                        waypoints, tracks):
+    # Walk the tree with our own stack instead of recursing, so deep
+    # trees do not run into the recursion limit
+    stack = collections.deque([folder])
+    while stack:
+        node = stack.pop()
+        if 'id' in node:
+            # The folder list only has ids of the contents. Skip any we
+            # cannot find, which can happen if the lists are not from
+            # the same moment.
+            properties = node.setdefault('properties', {})
+            properties['waypoints'] = [
+                waypoints_by_id[i] for i in node.get('waypoints', [])
+                if i in waypoints_by_id]
+            properties['tracks'] = [
+                tracks_by_id[i] for i in node.get('tracks', [])
+                if i in tracks_by_id]
+        else:
+            # This is the fake root folder
+            node['properties']['waypoints'] = [
+                w for w in waypoints if not w['folder']]
+            node['properties']['tracks'] = [
+                t for t in tracks if not t['folder']]
+
+        stack.extend(node.get('subfolders', {}).values())
+
+
 def title_sort(iterable):
     """Return a sorted list of items by title.
 
     :param iterable: Items to sort
     :returns: Items in title sort order
     """
-    return sorted(iterable, key=lambda e: e['title'])
+    return sorted(iterable, key=operator.itemgetter('title'))
 
 
 def name_sort(iterable):
@@ -312,6 +433,11 @@ def name_sort(iterable):
     return sorted(iterable, key=lambda e: e.get('name', ''))
 
 
+# Box-drawing branches for folder_lines()
+_MIDCHILD = '\u251c\u2500\u2500'
+_LASTCHILD = '\u2514\u2500\u2500'
+
+
 def pprint_folder(folder, indent=0, long=False):
     """Print a tree of folder contents.
 
@@ -323,9 +449,24 @@ def pprint_folder(folder, indent=0, long=False):
     :param indent: Number of spaces to indent the first level
     :type indent: int
     """
-    midchild = b'\xe2\x94\x9c\xe2\x94\x80\xe2\x94\x80'.decode()
-    lastchild = b'\xe2\x94\x94\xe2\x94\x80\xe2\x94\x80'.decode()
+    # Write it all at once, instead of a print() per line
+    sys.stdout.write(''.join('%s\n' % line
+                             for line in folder_lines(folder, indent, long)))
+
+
+def folder_lines(folder, indent=0, long=False):
+    """Generate the lines of a tree of folder contents.
 
+    This is what :func:`pprint_folder` prints, without the newlines.
+
+    :param folder: A folder tree root from :func:`resolve_tree`
+    :type folder: dict
+    :param indent: Number of spaces to indent the first level
+    :type indent: int
+    :param long: Include the datestamp of each item
+    :type long: bool
+    :returns: An iterator of `str` lines
+    """
     def format_thing(thing):
         fields = []
         if long:
@@ -335,26 +476,39 @@ def pprint_folder(folder, indent=0, long=False):
         return ' '.join(fields)
 
     if indent == 0:
-        print('/')
-
-    pfx = (' ' * indent) + midchild
-    for subf in name_sort(folder.get('subfolders', {}).values()):
-        print('%s %s/' % (pfx, format_thing(subf)))
-        pprint_folder(subf, indent=indent + 4, long=long)
-
-    children = (
-        [('W', w) for w in title_sort(
-            folder['properties']['waypoints'])] +
-        [('T', t) for t in title_sort(
-            folder['properties']['tracks'])])
-
-    while children:
-        char, child = children.pop(0)
-        if children:
-            pfx = (' ' * indent) + midchild
-        else:
-            pfx = (' ' * indent) + lastchild
-        print('%s [%s] %s' % (pfx, char, format_thing(child)))
+        yield '/'
+
+    # Walk the tree with our own stack instead of recursing, so deep
+    # trees do not run into the recursion limit. Each entry is either a
+    # subfolder whose line we still need to produce, or a folder whose
+    # waypoints and tracks come after all of its subfolders.
+    stack = collections.deque()
+
+    def push_folder(node, ind):
+        stack.append((node, ind, True))
+        for subf in reversed(name_sort(node.get('subfolders', {}).values())):
+            stack.append((subf, ind, False))
+
+    push_folder(folder, indent)
+    while stack:
+        node, ind, items = stack.pop()
+        if not items:
+            yield '%s%s %s/' % (' ' * ind, _MIDCHILD, format_thing(node))
+            push_folder(node, ind + 4)
+            continue
+
+        waypoints = node['properties']['waypoints']
+        tracks = node['properties']['tracks']
+        children = itertools.chain(
+            (('W', w) for w in title_sort(waypoints)),
+            (('T', t) for t in title_sort(tracks)))
+
+        spaces = ' ' * ind
+        last = len(waypoints) + len(tracks) - 1
+        for i, (char, child) in enumerate(children):
+            yield '%s%s [%s] %s' % (
+                spaces, _LASTCHILD if i == last else _MIDCHILD,
+                char, format_thing(child))
 
 
 def validate_lat(lat):
@@ -366,14 +520,16 @@ def validate_lat(lat):
     :type lat: str
     :returns: A latitude
     :rtype: `float`
-    :raises ValueError: If the latitude is not parseable or within constraints
+    :raises ValueError: If the latitude is not parseable or within
+                        constraints (including NaN)
     """
-    try:
-        lat = float(lat)
-    except ValueError:
-        raise ValueError('Latitude must be in decimal degree format')
+    if not isinstance(lat, float):
+        try:
+            lat = float(lat)
+        except ValueError:
+            raise ValueError('Latitude must be in decimal degree format')
 
-    if lat < -90 or lat > 90:
+    if not -90 <= lat <= 90:
         raise ValueError('Latitude must be between -90 and 90')
 
     return lat
@@ -388,14 +544,16 @@ def validate_lon(lon):
     :type lon: str
     :returns: A longitude
     :rtype: `float`
-    :raises ValueError: If the longitude is not parseable or within constraints
+    :raises ValueError: If the longitude is not parseable or within
+                        constraints (including NaN)
     """
-    try:
-        lon = float(lon)
-    except ValueError:
-        raise ValueError('Longitude must be in decimal degree format')
+    if not isinstance(lon, float):
+        try:
+            lon = float(lon)
+        except ValueError:
+            raise ValueError('Longitude must be in decimal degree format')
 
-    if lon < -180 or lon > 180:
+    if not -180 <= lon <= 180:
         raise ValueError('Longitude must be between -180 and 180')
 
     return lon
@@ -412,11 +570,12 @@ def validate_alt(alt):
     :rtype: `float`
     :raises ValueError: If the altitude is not parseable or within constraints
     """
-    try:
-        alt = int(alt)
-    except ValueError:
-        raise ValueError('Altitude must be a positive integer number of '
-                         'meters')
+    if not isinstance(alt, int) or isinstance(alt, bool):
+        try:
+            alt = int(alt)
+        except ValueError:
+            raise ValueError('Altitude must be a positive integer number of '
+                             'meters')
 
     if alt < 0:
         raise ValueError('Altitude must be positive')
@@ -424,6 +583,9 @@ def validate_alt(alt):
     return alt
 
 
+_ID_CHARS = frozenset(string.hexdigits + '-')
+
+
 def is_id(idstr):
     """Detect if a string is likely an API identifier
 
@@ -432,13 +594,15 @@ def is_id(idstr):
     :returns: ``True`` if the string is an identifier, ``False`` otherwise
     :rtype: `bool`
     """
-    return (len(idstr) in (36, 32) and
-            all(c in string.hexdigits + '-' for c in idstr))
+    return len(idstr) in (36, 32) and _ID_CHARS.issuperset(idstr)
 
 
+@functools.lru_cache(maxsize=1)
 def get_editor():
     """Return a path to an editor command, if possible.
 
+    The result is cached, so the environment is only probed once.
+
     :returns: Path to an editor command or None if one is not found
     """
 
@@ -455,7 +619,8 @@ def strip_gpx_extensions(source_file, dest_file):
 
     :param source_file: Source filename
     :type source_file: str
-    :param dest_file: Destination filename
+    :param dest_file: Destination filename, or a binary file object
+                      to write to
     :type dest_file: str
     :raises Exception: If the source file is not a GPX file
     """
@@ -545,6 +710,9 @@ class ThingFormatter(object):
     :type thing: dict
     """
 
+    # One of these is made for every item in a formatted listing
+    __slots__ = ('_thing',)
+
     def __init__(self, thing):
         self._thing = thing
 
@@ -561,8 +729,9 @@ class ThingFormatter(object):
         try:
             method = getattr(self, 'format_%s' % item)
         except AttributeError:
-            if item in self._find_props():
-                method = functools.partial(self._find_props().get, item)
+            props = self._find_props()
+            if item in props:
+                method = functools.partial(props.get, item)
             else:
                 LOG.info('Unsupported format key %r' % item)
                 method = lambda: 'UNSUPPORTED'  # noqa